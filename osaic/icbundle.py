@@ -0,0 +1,212 @@
+"""
+Single-file bundles of IC trees.
+
+A bundle is a plain concatenation of the files of a tree, each starting at a page-aligned offset and stored
+uncompressed, followed by a JSON index of members and a fixed-size trailer:
+
+    magic | member | pad | member | pad | ... | index JSON | index offset (8) | index size (8) | magic
+
+Members can be read directly from a memory-mapped bundle, without extracting it.
+"""
+
+import io
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import astropy.io.fits as fits
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"OSAICB01"
+ALIGN = 4096
+TRAILER = struct.Struct("<QQ8s")
+
+
+def aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def walk_tree(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if dirpath != root:
+            yield dirpath
+        for name in sorted(filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]):
+            yield os.path.join(dirpath, name)
+
+
+def bundle_tree(root, bundle_fn):
+    """
+    Packs all files of the tree under root into bundle_fn. Symbolic links are kept as links.
+    """
+    members = []
+    tmp_fn = "%s.%i.tmp" % (bundle_fn, os.getpid())
+
+    with open(tmp_fn, "wb") as out:
+        out.write(MAGIC)
+        offset = len(MAGIC)
+
+        for fn in walk_tree(root):
+            name = os.path.relpath(fn, root)
+            st = os.lstat(fn)
+
+            if os.path.islink(fn):
+                members.append(dict(name=name, link=os.readlink(fn)))
+                continue
+
+            if os.path.isdir(fn):
+                members.append(dict(name=name, dir=True, mode=st.st_mode & 0o7777))
+                continue
+
+            offset = aligned(offset)
+            out.seek(offset)
+            with open(fn, "rb") as f:
+                shutil.copyfileobj(f, out, 1 << 20)
+
+            members.append(dict(name=name, offset=offset, size=st.st_size, mode=st.st_mode & 0o7777, mtime=st.st_mtime))
+            offset += st.st_size
+
+        index = json.dumps(dict(root=os.path.basename(os.path.normpath(root)), members=members)).encode()
+        out.seek(offset)
+        out.write(index)
+        out.write(TRAILER.pack(offset, len(index), MAGIC))
+
+    os.replace(tmp_fn, bundle_fn)
+
+    logger.info("bundled %s members of %s into %s, %.5lg Mb", len(members), root, bundle_fn, os.path.getsize(bundle_fn) / 1024. / 1024.)
+
+    return members
+
+
+class MemberFile(io.RawIOBase):
+    """
+    Read-only file object over one member of a memory-mapped bundle.
+    """
+
+    def __init__(self, mm, offset, size):
+        super().__init__()
+        self.mm = mm
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = position
+        elif whence == io.SEEK_CUR:
+            self.position += position
+        else:
+            self.position = self.size + position
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        n = max(0, min(len(buffer), self.size - self.position))
+        start = self.offset + self.position
+        buffer[:n] = self.mm[start:start + n]
+        self.position += n
+        return n
+
+
+class ICBundle:
+    def __init__(self, bundle_fn):
+        self.bundle_fn = bundle_fn
+        self.f = open(bundle_fn, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("not an IC bundle: %s" % bundle_fn)
+
+        index_offset, index_size, magic = TRAILER.unpack(self.mm[-TRAILER.size:])
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("truncated IC bundle: %s" % bundle_fn)
+
+        index = json.loads(self.mm[index_offset:index_offset + index_size])
+        self.root = index['root']
+        self.members = {member['name']: member for member in index['members']}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+    def names(self):
+        return [name for name, member in self.members.items() if 'dir' not in member]
+
+    def member(self, name):
+        member = self.members[name]
+        if 'link' in member:
+            return self.member(os.path.normpath(os.path.join(os.path.dirname(name), member['link'])))
+        return member
+
+    def member_view(self, name):
+        """
+        Zero-copy view of the member content.
+        """
+        member = self.member(name)
+        return memoryview(self.mm)[member['offset']:member['offset'] + member['size']]
+
+    def open_member(self, name):
+        member = self.member(name)
+        return MemberFile(self.mm, member['offset'], member['size'])
+
+    def open_fits(self, name):
+        """
+        Opens member FITS file in place; HDUs are read from the mapped bundle when accessed.
+        """
+        return fits.open(self.open_member(name))
+
+    def extract_member(self, name, dest):
+        member = self.members[name]
+        fn = os.path.join(dest, name)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+
+        if 'link' in member:
+            if os.path.lexists(fn):
+                os.remove(fn)
+            os.symlink(member['link'], fn)
+            return fn
+
+        with open(fn, "wb") as f:
+            f.write(self.member_view(name))
+        os.chmod(fn, member['mode'])
+        os.utime(fn, (member['mtime'], member['mtime']))
+
+        return fn
+
+    def extract(self, dest, workers=8):
+        for name, member in self.members.items():
+            if 'dir' in member:
+                os.makedirs(os.path.join(dest, name), exist_ok=True)
+
+        names = self.names()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for fn in pool.map(lambda name: self.extract_member(name, dest), names):
+                logger.debug("extracted %s", fn)
+
+        logger.info("extracted %s members of %s into %s", len(names), self.bundle_fn, dest)
+
+
+def unbundle(bundle_fn, dest, workers=8):
+    with ICBundle(bundle_fn) as bundle:
+        bundle.extract(dest, workers)
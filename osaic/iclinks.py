@@ -0,0 +1,80 @@
+"""
+IC trees sharing files through hard links.
+
+Linked files must never be modified in place: files are replaced (written aside and renamed over), and files which are
+updated in place, like the master file, are unshared first.
+"""
+
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+
+def link_file(src, dst):
+    """
+    Makes dst a hard link to src, replacing dst atomically; copies if src is on another file system.
+    """
+    tmp_fn = "%s.%i.tmp" % (dst, os.getpid())
+    try:
+        os.link(src, tmp_fn)
+    except OSError:
+        shutil.copy2(src, tmp_fn)
+    os.replace(tmp_fn, dst)
+
+
+def link_tree(src_root, dst_root):
+    """
+    Links files of src_root into dst_root. As with rsync -u, files of dst_root newer than the source are kept.
+    """
+    n_linked = 0
+
+    for dirpath, dirnames, filenames in os.walk(src_root):
+        dst_dir = os.path.join(dst_root, os.path.relpath(dirpath, src_root))
+        os.makedirs(dst_dir, exist_ok=True)
+
+        for name in filenames:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(dst_dir, name)
+
+            if os.path.islink(src):
+                if not os.path.lexists(dst):
+                    os.symlink(os.readlink(src), dst)
+                continue
+
+            if os.path.exists(dst) and (os.path.samefile(src, dst) or os.path.getmtime(dst) >= os.path.getmtime(src)):
+                continue
+
+            link_file(src, dst)
+            n_linked += 1
+
+    logger.info("linked %s files of %s into %s", n_linked, src_root, dst_root)
+
+    return n_linked
+
+
+def unshare_file(fn):
+    """
+    Replaces fn by a private copy if it is linked elsewhere, before it is modified in place.
+    """
+    if not os.path.exists(fn) or os.stat(fn).st_nlink <= 1:
+        return False
+
+    tmp_fn = "%s.%i.tmp" % (fn, os.getpid())
+    shutil.copy2(fn, tmp_fn)
+    os.replace(tmp_fn, fn)
+
+    logger.debug("unshared %s", fn)
+
+    return True
+
+
+def write_replacing(fn, content):
+    """
+    Writes a new file in place of fn, leaving other links to the old one unchanged.
+    """
+    tmp_fn = "%s.%i.tmp" % (fn, os.getpid())
+    with open(tmp_fn, "w") as f:
+        f.write(content)
+    os.replace(tmp_fn, fn)
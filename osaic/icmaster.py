@@ -0,0 +1,105 @@
+"""
+Editing of the IC master file.
+
+The master file keeps the group of IC indices in extension 2 and the
+configuration table with one version column per DS in extension 3.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+
+import astropy.io.fits as fits
+
+logger = logging.getLogger(__name__)
+
+MASTER_GROUP_EXT = 2
+MASTER_CONFIG_EXT = 3
+
+
+def master_changes(f, values, ext=MASTER_CONFIG_EXT):
+    """
+    Compares the configuration table of an open master file with the requested column values.
+
+    Returns the list of missing columns and the dict of values which differ (including the missing ones).
+    """
+    names = set(f[ext].columns.names)
+
+    new_columns = [name for name in values if name not in names]
+    changed = {name: value for name, value in values.items()
+               if name not in names or f[ext].data[0][name] != value}
+
+    return new_columns, changed
+
+
+def update_master(master_fn, values, ext=MASTER_CONFIG_EXT):
+    """
+    Sets version columns in the master configuration table, adding the missing ones as "1I".
+
+    The file is not touched if it already holds the requested values. Otherwise it is written once:
+    in place if only values change, through a temporary file if the table has to be extended.
+    All other HDUs are kept as they are.
+
+    Returns True if the file was written.
+    """
+    with fits.open(master_fn) as f:
+        logger.info("ic master file starts with columns: %s", len(f[ext].columns))
+        logger.debug(f[ext].columns.names)
+
+        new_columns, changed = master_changes(f, values, ext)
+
+        if len(changed) == 0:
+            logger.info("ic master file already up to date, not writing: %s", master_fn)
+            return False
+
+        if len(new_columns) == 0:
+            new_columns_hdu = None
+        else:
+            new_columns_hdu = fits.BinTableHDU.from_columns(
+                    f[ext].columns + fits.ColDefs([fits.Column(name, "1I") for name in new_columns]),
+                    header=f[ext].header)
+
+    if new_columns_hdu is None:
+        with fits.open(master_fn, mode="update") as f:
+            for name, value in changed.items():
+                f[ext].data[0][name] = value
+        logger.info("ic master file updated in place with values: %s", changed)
+        return True
+
+    with fits.open(master_fn) as f:
+        for name, value in changed.items():
+            new_columns_hdu.data[0][name] = value
+
+        f[ext] = new_columns_hdu
+
+        logger.info("ic master file complete with columns: %s", len(f[ext].columns))
+
+        fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(master_fn)), suffix=".fits")
+        os.close(fd)
+        try:
+            f.writeto(tmp_fn, overwrite=True)
+            shutil.copymode(master_fn, tmp_fn)
+        except Exception:
+            os.remove(tmp_fn)
+            raise
+
+    os.replace(tmp_fn, master_fn)
+
+    return True
+
+
+def master_members(master_fn, ext=MASTER_GROUP_EXT):
+    """
+    Returns normalized paths of the members of the master group.
+    """
+    master_dir = os.path.dirname(os.path.abspath(master_fn))
+
+    with fits.open(master_fn) as f:
+        if 'MEMBER_LOCATION' not in f[ext].columns.names:
+            return set()
+
+        return set(
+            os.path.normpath(os.path.join(master_dir, location.strip()))
+            for location in f[ext].data['MEMBER_LOCATION'] if location.strip() != ""
+        )
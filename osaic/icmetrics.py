@@ -0,0 +1,181 @@
+"""
+Metrics of the IC collection, accumulated from build reports.
+
+Every build report is kept in <metrics_dir>/reports and folded into <metrics_dir>/state.json, from which
+<metrics_dir>/metrics.prom (Prometheus text format, e.g. for the node exporter textfile collector)
+and <metrics_dir>/metrics.json are exported. The collection itself is never walked.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = "state.json"
+
+
+def empty_state():
+    return dict(
+        versions={},
+        builds_total=0,
+        build_seconds_total=0.,
+        heatool_calls_total={},
+        files_scanned_total=0,
+        files_scan_cached_total=0,
+        files_copied_total=0,
+        bytes_copied_total=0,
+    )
+
+
+def fold_report(state, report):
+    """
+    Updates the collection state with one build report.
+    """
+    version = report['version']
+
+    version_state = state['versions'].setdefault(version, dict(DS={}))
+    # in-place updates only touch some DS, keep the others from earlier builds
+    for DS, ds_report in report['DS'].items():
+        version_state['DS'][DS] = dict(n_files=ds_report['n_files'], size=ds_report['size'])
+    version_state['last_build_seconds'] = report['duration']
+    version_state['last_build_time'] = report['finished']
+
+    state['builds_total'] += 1
+    state['build_seconds_total'] += report['duration']
+
+    for tool, n in report.get('heatool_calls', {}).items():
+        state['heatool_calls_total'][tool] = state['heatool_calls_total'].get(tool, 0) + n
+
+    scan = report.get('scan', {})
+    state['files_scanned_total'] += scan.get('scanned', 0)
+    state['files_scan_cached_total'] += scan.get('cached', 0)
+
+    totals = report.get('plan_totals') or {}
+    state['files_copied_total'] += totals.get('copy', 0)
+    state['bytes_copied_total'] += totals.get('bytes', 0)
+
+    return state
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus_text(state):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples:
+            if labels:
+                label_text = "{" + ",".join('%s="%s"' % (k, escape_label(v)) for k, v in labels.items()) + "}"
+            else:
+                label_text = ""
+            lines.append("%s%s %s" % (name, label_text, value))
+
+    versions = state['versions']
+
+    metric("osaic_ic_files", "gauge", "Number of IC files built per version and DS",
+           [(dict(version=v, ds=DS), d['n_files']) for v, vs in versions.items() for DS, d in vs['DS'].items()])
+    metric("osaic_ic_bytes", "gauge", "Size of IC files built per version and DS",
+           [(dict(version=v, ds=DS), d['size']) for v, vs in versions.items() for DS, d in vs['DS'].items()])
+    metric("osaic_collection_files", "gauge", "Number of IC files built in the collection",
+           [({}, sum(d['n_files'] for vs in versions.values() for d in vs['DS'].values()))])
+    metric("osaic_collection_bytes", "gauge", "Size of IC files built in the collection",
+           [({}, sum(d['size'] for vs in versions.values() for d in vs['DS'].values()))])
+    metric("osaic_collection_versions", "gauge", "Number of IC versions built",
+           [({}, len(versions))])
+    metric("osaic_build_duration_seconds", "gauge", "Duration of the last build of each version",
+           [(dict(version=v), vs['last_build_seconds']) for v, vs in versions.items()])
+    metric("osaic_build_last_timestamp_seconds", "gauge", "End time of the last build of each version",
+           [(dict(version=v), vs['last_build_time']) for v, vs in versions.items()])
+    metric("osaic_builds_total", "counter", "Number of builds",
+           [({}, state['builds_total'])])
+    metric("osaic_build_seconds_total", "counter", "Time spent in builds",
+           [({}, state['build_seconds_total'])])
+    metric("osaic_heatool_calls_total", "counter", "Number of heatool calls in builds",
+           [(dict(tool=tool), n) for tool, n in state['heatool_calls_total'].items()])
+    metric("osaic_scan_files_total", "counter", "Number of IC files scanned, by scan cache result",
+           [(dict(cache="miss"), state['files_scanned_total']), (dict(cache="hit"), state['files_scan_cached_total'])])
+    metric("osaic_copied_files_total", "counter", "Number of IC files stored",
+           [({}, state['files_copied_total'])])
+    metric("osaic_copied_bytes_total", "counter", "Size of IC input files stored",
+           [({}, state['bytes_copied_total'])])
+
+    return "\n".join(lines) + "\n"
+
+
+def metrics_json(state):
+    scanned = state['files_scanned_total'] + state['files_scan_cached_total']
+    return dict(
+        state,
+        scan_cache_hit_rate=state['files_scan_cached_total'] / scanned if scanned > 0 else None,
+    )
+
+
+def write_atomic(fn, content):
+    tmp_fn = "%s.%i.tmp" % (fn, os.getpid())
+    with open(tmp_fn, "w") as f:
+        f.write(content)
+    os.replace(tmp_fn, fn)
+
+
+def export_metrics(metrics_dir, state):
+    write_atomic(os.path.join(metrics_dir, "metrics.prom"), prometheus_text(state))
+    write_atomic(os.path.join(metrics_dir, "metrics.json"), json.dumps(metrics_json(state), indent=1))
+
+
+def read_state(metrics_dir):
+    try:
+        with open(os.path.join(metrics_dir, STATE_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return empty_state()
+
+
+@contextlib.contextmanager
+def locked(metrics_dir):
+    """
+    Serializes updates of the metrics directory between processes; creates the directory if needed.
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    with open(os.path.join(metrics_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def refresh_metrics(metrics_dir):
+    """
+    Exports metrics from the current state, also when no build was recorded yet.
+    """
+    with locked(metrics_dir):
+        state = read_state(metrics_dir)
+        export_metrics(metrics_dir, state)
+
+    return state
+
+
+def record_build(metrics_dir, report):
+    """
+    Stores the build report, updates the collection state and exports metrics.
+
+    Concurrent builds are serialized with a lock on the metrics directory.
+    """
+    os.makedirs(os.path.join(metrics_dir, "reports"), exist_ok=True)
+
+    report_fn = os.path.join(metrics_dir, "reports", "%s-%s.json" % (report['version'], time.strftime("%y%m%d.%H%M%S", time.gmtime(report['finished']))))
+    write_atomic(report_fn, json.dumps(report, indent=1, default=str))
+
+    with locked(metrics_dir):
+        state = fold_report(read_state(metrics_dir), report)
+        write_atomic(os.path.join(metrics_dir, STATE_NAME), json.dumps(state, indent=1))
+        export_metrics(metrics_dir, state)
+
+    logger.info("build report recorded in %s", report_fn)
+
+    return state
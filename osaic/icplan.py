@@ -0,0 +1,85 @@
+"""
+Build plans: what a build would do to an IC tree, computed before doing it.
+
+A plan is a JSON-serializable dict made by ICTree.plan and executed by ICTree.execute_plan.
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# rough throughput figures used for the cost estimate
+COPY_BYTES_PER_SECOND = 50e6
+HEATOOL_SECONDS = 2.
+
+COPY = "copy"
+SKIP = "skip"
+SUPERSEDED = "superseded"
+COMPACTED = "compacted"
+
+CREATE = "create"
+RECREATE = "recreate"
+KEEP = "keep"
+
+
+def plan_totals(plan):
+    files = plan['files']
+    indices = plan['indices']
+
+    heatool_calls = sum(1 + int(index['attach']) for index in indices if index['action'] != KEEP)
+
+    totals = dict(
+        copy=sum(1 for f in files if f['action'] == COPY),
+        skip=sum(1 for f in files if f['action'] == SKIP),
+        superseded=sum(1 for f in files if f['action'] == SUPERSEDED),
+        compacted=sum(1 for f in files if f['action'] == COMPACTED),
+        bytes=sum(f['bytes'] for f in files if f['action'] == COPY),
+        indices=sum(1 for index in indices if index['action'] != KEEP),
+        master_columns=len(plan['master']['changed']),
+        heatool_calls=heatool_calls,
+    )
+
+    totals['estimated_seconds'] = totals['bytes'] / COPY_BYTES_PER_SECOND + heatool_calls * HEATOOL_SECONDS
+    totals['nothing_to_do'] = totals['copy'] == 0 and totals['indices'] == 0 and totals['master_columns'] == 0
+
+    return totals
+
+
+def input_state(fn):
+    """
+    Size and modification time of an input file, recorded in plan entries.
+    """
+    st = os.stat(fn)
+    return dict(input_size=st.st_size, input_mtime_ns=st.st_mtime_ns)
+
+
+def changed_inputs(files, path=lambda fn: fn):
+    """
+    Input files of plan entries which changed or disappeared since the plan was made; path maps origin filenames
+    to the files to check. Entries without recorded state are not checked.
+    """
+    changed = []
+    for entry in files:
+        if 'input_size' not in entry:
+            continue
+        fn = path(entry['origin_filename'])
+        if not os.path.exists(fn) or input_state(fn) != dict(input_size=entry['input_size'], input_mtime_ns=entry['input_mtime_ns']):
+            changed.append(entry['origin_filename'])
+    return sorted(set(changed))
+
+
+def write_plan(plan, fn):
+    if fn == "-":
+        print(json.dumps(plan, indent=1))
+        return
+
+    with open(fn, "w") as f:
+        json.dump(plan, f, indent=1)
+    logger.info("plan written to %s", fn)
+
+
+def read_plan(fn):
+    with open(fn) as f:
+        return json.load(f)
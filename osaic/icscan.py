@@ -0,0 +1,88 @@
+"""
+Caching and concurrent scanning of IC file metadata.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ScanCache:
+    """
+    Metadata of scanned IC files, kept between builds.
+
+    Entries are keyed by absolute path, modification time and size of the IC file, so that a changed file is scanned again.
+    The cache is bounded: least recently used entries are dropped beyond maxsize.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(fn):
+        st = os.stat(fn)
+        return (os.path.abspath(fn), st.st_mtime_ns, st.st_size)
+
+    def get(self, fn):
+        try:
+            key = self.key(fn)
+        except OSError:
+            return None
+
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, fn, value):
+        key = self.key(fn)
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._entries), hits=self.hits, misses=self.misses)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+async def gather_bounded(func, items, concurrency=16):
+    """
+    Runs blocking func on every item in worker threads, with at most concurrency calls in flight.
+
+    Returns results in the order of items; exceptions are returned in place of results.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(item):
+        async with semaphore:
+            return await asyncio.to_thread(func, item)
+
+    return await asyncio.gather(*(run_one(item) for item in items), return_exceptions=True)
+
+
+def scan_concurrently(func, items, concurrency=16):
+    """
+    Overlaps latency of per-file scans, which dominates on network file systems.
+    """
+    items = [item for item in items]
+    logger.info("scanning %s files with concurrency %s", len(items), concurrency)
+    return asyncio.run(gather_bounded(func, items, concurrency))
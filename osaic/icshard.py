@@ -0,0 +1,100 @@
+"""
+Partitioning of IC builds into shards, built independently and merged into one tree.
+
+A shard holds all members of some (DS, revolution range) buckets, so that members which could collide in the tree
+always end up in the same shard.
+"""
+
+import json
+import logging
+import os
+import shutil
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "shard.json"
+
+
+def parse_shard(shard):
+    """
+    Parses "K/N" shard specification into (K, N), with K counted from 0.
+    """
+    k, n = [int(x) for x in shard.split("/")]
+    if not 0 <= k < n:
+        raise ValueError("shard %s out of range, expected K/N with 0 <= K < N" % shard)
+    return k, n
+
+
+def shard_key(DS, serial, revs_per_shard):
+    return "%s:%i" % (DS, serial // revs_per_shard)
+
+
+def shard_of(DS, serial, n_shards, revs_per_shard):
+    return zlib.crc32(shard_key(DS, serial, revs_per_shard).encode()) % n_shards
+
+
+def manifest_fn(shard_dir):
+    return os.path.join(shard_dir, MANIFEST_NAME)
+
+
+def write_manifest(shard_dir, shard, n_shards, revs_per_shard, entries):
+    manifest = dict(
+        shard=shard,
+        n_shards=n_shards,
+        revs_per_shard=revs_per_shard,
+        files=entries,
+    )
+
+    tmp_fn = manifest_fn(shard_dir) + ".tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_fn, manifest_fn(shard_dir))
+
+    logger.info("shard %s/%s manifest with %s files written to %s", shard, n_shards, len(entries), manifest_fn(shard_dir))
+
+
+def read_manifest(shard_dir):
+    with open(manifest_fn(shard_dir)) as f:
+        return json.load(f)
+
+
+def read_manifests(shard_dirs):
+    """
+    Reads the manifests of all shards of a build, checking that they make one complete build and still hold their
+    stored files, before anything is merged.
+    """
+    manifests = []
+    for shard_dir in shard_dirs:
+        if not os.path.exists(manifest_fn(shard_dir)):
+            raise ValueError("no shard manifest in %s" % shard_dir)
+        manifests.append(read_manifest(shard_dir))
+
+    if len(manifests) == 0:
+        raise ValueError("no shards to merge")
+
+    layouts = sorted(set((manifest['n_shards'], manifest['revs_per_shard']) for manifest in manifests))
+    if len(layouts) > 1:
+        raise ValueError("shards of different builds, as (n_shards, revs_per_shard): %s" % layouts)
+    n_shards = layouts[0][0]
+
+    shards = sorted(manifest['shard'] for manifest in manifests)
+    if shards != list(range(n_shards)):
+        raise ValueError("expected each of the %s shards once, got %s" % (n_shards, shards))
+
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        missing = sorted(stored for stored in set(entry['stored'] for entry in manifest['files'])
+                         if not os.path.exists(os.path.join(shard_dir, stored)))
+        if len(missing) > 0:
+            raise ValueError("%s files of shard %s are missing from %s, e.g. %s: was it merged already?" % (
+                len(missing), manifest['shard'], shard_dir, missing[0]))
+
+    return manifests
+
+
+def move_file(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError:
+        # shard on another file system
+        shutil.move(src, dst)
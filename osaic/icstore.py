@@ -0,0 +1,277 @@
+"""
+Streaming copy of IC files into the tree.
+
+FITS files are copied block by block, decompressing gzip on the fly, so that memory use does not depend on the file size.
+Header keywords are patched while copying: cards have fixed size, so the data never moves.
+"""
+
+import contextvars
+import gzip
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import astropy.io.fits as fits
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+CHUNK_SIZE = 1 << 20
+
+# keywords left out of extension digests: validity and bookkeeping, which differ between members with the same content
+DIGEST_IGNORED_KEYWORDS = frozenset([
+    "VSTART", "VSTOP", "DATE", "CREATOR", "CONFIGUR", "ORIGIN", "FILENAME", "CHECKSUM", "DATASUM", "HISTORY", "COMMENT",
+])
+
+
+def open_fits_stream(fn):
+    with open(fn, "rb") as f:
+        magic = f.read(2)
+
+    if magic == b"\x1f\x8b":
+        return gzip.open(fn, "rb")
+
+    return open(fn, "rb")
+
+
+def read_exactly(stream, size):
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            raise EOFError("unexpected end of FITS file")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_header(stream):
+    """
+    Returns raw header blocks of the next HDU, or None at the end of file.
+    """
+    blocks = []
+    while True:
+        block = stream.read(BLOCK_SIZE)
+        if not block:
+            if blocks:
+                raise EOFError("unexpected end of FITS header")
+            return None
+        if len(block) < BLOCK_SIZE:
+            block += read_exactly(stream, BLOCK_SIZE - len(block))
+        blocks.append(block)
+
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            if block[i:i + 8] == b"END     ":
+                return b"".join(blocks)
+
+
+def header_cards(header):
+    for i in range(0, len(header), CARD_SIZE):
+        card = header[i:i + CARD_SIZE]
+        yield card
+        if card[:8] == b"END     ":
+            return
+
+
+def header_keyword(header, keyword, default=None):
+    key = keyword.encode().ljust(8)
+    for card in header_cards(header):
+        if card[:8] == key and card[8:10] == b"= ":
+            return card[10:].split(b"/")[0].strip().decode()
+    return default
+
+
+def data_size(header):
+    """
+    Size of the data following the header, padded to full blocks.
+    """
+    naxis = int(header_keyword(header, "NAXIS", 0))
+    if naxis == 0:
+        return 0
+
+    bitpix = int(header_keyword(header, "BITPIX"))
+    pcount = int(header_keyword(header, "PCOUNT", 0))
+    gcount = int(header_keyword(header, "GCOUNT", 1))
+
+    n = 1
+    for i in range(1, naxis + 1):
+        n *= int(header_keyword(header, "NAXIS%i" % i))
+
+    size = abs(bitpix) // 8 * gcount * (pcount + n)
+
+    return (size + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+
+def patch_header(header, updates):
+    """
+    Sets keyword values in raw header blocks, keeping existing comments; missing keywords are added before END.
+    """
+    if not updates:
+        return header
+
+    updates = dict(updates)
+    cards = []
+    for card in header_cards(header):
+        if card[:8] == b"END     ":
+            break
+
+        keyword = card[:8].decode().strip()
+        if keyword in updates and card[8:10] == b"= ":
+            comment = fits.Card.fromstring(card.decode()).comment
+            card = fits.Card(keyword, updates.pop(keyword), comment).image.encode()
+
+        cards.append(card)
+
+    for keyword, value in updates.items():
+        cards.append(fits.Card(keyword, value).image.encode())
+
+    cards.append(b"END".ljust(CARD_SIZE))
+
+    patched = b"".join(cards)
+    n_blocks = (len(patched) + BLOCK_SIZE - 1) // BLOCK_SIZE
+    return patched.ljust(n_blocks * BLOCK_SIZE, b" ")
+
+
+def digest_cards(header):
+    """
+    Header cards which make the content of an extension, see DIGEST_IGNORED_KEYWORDS.
+    """
+    for card in header_cards(header):
+        keyword = card[:8].decode().strip()
+        if keyword == "END":
+            return
+        if keyword != "" and keyword not in DIGEST_IGNORED_KEYWORDS:
+            yield card
+
+
+def copy_stream(stream, outputs, size, chunk_size=CHUNK_SIZE):
+    while size > 0:
+        chunk = stream.read(min(chunk_size, size))
+        if not chunk:
+            raise EOFError("unexpected end of FITS data")
+        for output in outputs:
+            output.write(chunk)
+        size -= len(chunk)
+
+
+def split_icfile(fn, targets, chunk_size=CHUNK_SIZE):
+    """
+    Copies selected extensions of a FITS file each into its own file, reading the source once.
+
+    targets maps extension number to (destination filename, header updates). Every destination gets the primary HDU
+    of the source followed by its extension. Destinations are replaced atomically when complete.
+
+    Returns the dict of written sizes by destination.
+    """
+    tmp_fns = {ext: "%s.%i.tmp" % (dst, os.getpid()) for ext, (dst, updates) in targets.items()}
+    outputs = {}
+
+    try:
+        with open_fits_stream(fn) as stream:
+            primary = read_header(stream)
+            if primary is None:
+                raise EOFError("empty FITS file: %s" % fn)
+            primary_data = read_exactly(stream, data_size(primary))
+
+            for ext, tmp_fn in tmp_fns.items():
+                outputs[ext] = open(tmp_fn, "wb")
+                outputs[ext].write(primary)
+                outputs[ext].write(primary_data)
+
+            ext = 0
+            while True:
+                header = read_header(stream)
+                if header is None:
+                    break
+                ext += 1
+
+                if ext in targets:
+                    outputs[ext].write(patch_header(header, targets[ext][1]))
+                    selected = [outputs[ext]]
+                else:
+                    selected = []
+
+                copy_stream(stream, selected, data_size(header), chunk_size)
+
+        missing = set(targets) - set(range(1, ext + 1))
+        if missing:
+            raise ValueError("%s has no extensions %s" % (fn, sorted(missing)))
+
+        for output in outputs.values():
+            output.close()
+
+        sizes = {}
+        for ext, (dst, updates) in targets.items():
+            os.replace(tmp_fns[ext], dst)
+            sizes[dst] = os.path.getsize(dst)
+
+        return sizes
+
+    finally:
+        for ext, output in outputs.items():
+            output.close()
+            if os.path.exists(tmp_fns[ext]):
+                os.remove(tmp_fns[ext])
+
+
+def extension_digests(fn, extensions=None, chunk_size=CHUNK_SIZE):
+    """
+    Digests of FITS extensions (all by default), reading the file once. Validity and bookkeeping keywords are left
+    out, so that members differing only in those have the same digest.
+    """
+    digests = {}
+
+    with open_fits_stream(fn) as stream:
+        primary = read_header(stream)
+        if primary is None:
+            raise EOFError("empty FITS file: %s" % fn)
+        read_exactly(stream, data_size(primary))
+
+        ext = 0
+        while True:
+            header = read_header(stream)
+            if header is None:
+                break
+            ext += 1
+
+            size = data_size(header)
+            if extensions is None or ext in extensions:
+                digest = hashlib.sha1()
+                for card in digest_cards(header):
+                    digest.update(card)
+                while size > 0:
+                    chunk = stream.read(min(chunk_size, size))
+                    if not chunk:
+                        raise EOFError("unexpected end of FITS data")
+                    digest.update(chunk)
+                    size -= len(chunk)
+                digests[ext] = digest.hexdigest()
+            else:
+                copy_stream(stream, [], size, chunk_size)
+
+    return digests
+
+
+def store_icfile(fn, dst, header_updates=None, chunk_size=CHUNK_SIZE):
+    """
+    Stores single-extension IC file, decompressing and patching the extension header on the fly.
+    """
+    logger.debug("streaming %s to %s with %s", fn, dst, header_updates)
+    return split_icfile(fn, {1: (dst, header_updates or {})}, chunk_size)[dst]
+
+
+def run_parallel(func, items, workers=4):
+    """
+    Maps func over items in a thread pool; gzip decompression releases the GIL.
+
+    Each call runs in a copy of the caller's context, so that context variables (e.g. the current service job) follow.
+    """
+    items = [item for item in items]
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, func, item) for item in items]
+        return [future.result() for future in futures]
@@ -0,0 +1,82 @@
+"""
+Registry of IC files collected for an IC tree, kept per ICTree instance.
+"""
+
+
+class ICFile:
+    """
+    One IC file to be stored in the tree.
+
+    The scan fills origin_filename, version, serial, hashe, extension and digest; write fills the rest.
+    extension is the member extension of an indexed input file, None for single IC files.
+    digest is the digest of the member data, if computed; vstop overrides the stored VSTOP of compacted members.
+    """
+    __slots__ = ('origin_filename', 'version', 'serial', 'hashe', 'extension', 'digest', 'vstop', 'size', 'ic_store_filename', 'version_store')
+
+    def __init__(self, origin_filename, version, serial, hashe="", extension=None, digest=None):
+        self.origin_filename = origin_filename
+        self.version = version
+        self.serial = serial
+        self.hashe = hashe
+        self.extension = extension
+        self.digest = digest
+        self.vstop = None
+        self.size = None
+        self.ic_store_filename = None
+        self.version_store = None
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d):
+        icfile = cls(d['origin_filename'], d['version'], d['serial'], d.get('hashe', ""), d.get('extension'), d.get('digest'))
+        for k in ('vstop', 'size', 'ic_store_filename', 'version_store'):
+            setattr(icfile, k, d.get(k))
+        return icfile
+
+    def __repr__(self):
+        return "ICFile(%s)" % ", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__)
+
+
+class ICStructures:
+    """
+    IC files of a tree grouped by DS, in the order they were added.
+
+    Behaves as a read-only mapping from DS to the list of ICFile records.
+    """
+    __slots__ = ('_by_DS',)
+
+    def __init__(self):
+        self._by_DS = {}
+
+    def add(self, DS, icfile):
+        self._by_DS.setdefault(DS, []).append(icfile)
+        return icfile
+
+    def __getitem__(self, DS):
+        return self._by_DS[DS]
+
+    def __contains__(self, DS):
+        return DS in self._by_DS
+
+    def __iter__(self):
+        return iter(self._by_DS)
+
+    def __len__(self):
+        return len(self._by_DS)
+
+    def keys(self):
+        return self._by_DS.keys()
+
+    def items(self):
+        return self._by_DS.items()
+
+    def values(self):
+        return self._by_DS.values()
+
+    def n_files(self):
+        return sum(len(icfiles) for icfiles in self._by_DS.values())
+
+    def clear(self):
+        self._by_DS.clear()
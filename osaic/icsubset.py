@@ -0,0 +1,140 @@
+"""
+Extraction of the part of an IC tree valid for a range of time, for analysis jobs which need only a few revolutions.
+
+The subset tree keeps the layout of the original: index members are linked (or copied across file systems),
+indices are trimmed to the selected members, and the master file is copied.
+"""
+
+import logging
+import os
+import shutil
+
+import astropy.io.fits as fits
+import numpy as np
+
+from osaic.icmaster import MASTER_GROUP_EXT
+
+logger = logging.getLogger(__name__)
+
+
+def parse_rev_range(revs):
+    """
+    Parses "A-B" or "A" into an inclusive revolution range.
+    """
+    if "-" in revs:
+        rev_start, rev_stop = [int(x) for x in revs.split("-", 1)]
+    else:
+        rev_start = rev_stop = int(revs)
+
+    if rev_stop < rev_start:
+        raise ValueError("empty revolution range: %s" % revs)
+
+    return rev_start, rev_stop
+
+
+def select_members(vstart, vstop, version, ijd_start, ijd_stop):
+    """
+    Selects index rows in effect within [ijd_start, ijd_stop): members starting in the range,
+    and for each VERSION the latest member starting before it, if still valid at the range start.
+    """
+    vstart = np.asarray(vstart)
+    vstop = np.asarray(vstop)
+    version = np.asarray(version)
+
+    intersecting = (vstart < ijd_stop) & (vstop >= ijd_start)
+    selected = intersecting & (vstart >= ijd_start)
+
+    for v in np.unique(version):
+        earlier = intersecting & (vstart < ijd_start) & (version == v)
+        if earlier.any():
+            selected |= earlier & (vstart == vstart[earlier].max())
+
+    return selected
+
+
+def link_or_copy(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def group_locations(fn, ext):
+    with fits.open(fn) as f:
+        if 'MEMBER_LOCATION' not in f[ext].columns.names:
+            return []
+        return [str(location).strip() for location in f[ext].data['MEMBER_LOCATION']]
+
+
+def subset_index(src_root, dst_root, idx_fn, ijd_start, ijd_stop):
+    """
+    Writes the trimmed index into dst_root, linking selected members; returns number of (kept, all) members.
+    """
+    dst_idx_fn = os.path.join(dst_root, os.path.relpath(idx_fn, src_root))
+    os.makedirs(os.path.dirname(dst_idx_fn), exist_ok=True)
+
+    with fits.open(idx_fn) as f:
+        data = f[1].data
+        names = data.columns.names
+
+        if 'VSTART' not in names or 'VSTOP' not in names:
+            logger.info("%s is not a time-indexed group, keeping all members", idx_fn)
+            selected = np.ones(len(data), dtype=bool)
+        else:
+            version = data['VERSION'] if 'VERSION' in names else np.zeros(len(data))
+            selected = select_members(data['VSTART'], data['VSTOP'], version, ijd_start, ijd_stop)
+
+        for location in data['MEMBER_LOCATION'][selected]:
+            member_fn = os.path.normpath(os.path.join(os.path.dirname(idx_fn), str(location).strip()))
+            if os.path.relpath(member_fn, src_root).startswith(".."):
+                logger.warning("member %s is outside of %s, not linking", member_fn, src_root)
+                continue
+
+            dst_member_fn = os.path.join(dst_root, os.path.relpath(member_fn, src_root))
+            link_or_copy(member_fn, dst_member_fn)
+
+            version_store = os.path.join(os.path.dirname(member_fn), ".version." + os.path.basename(member_fn))
+            if os.path.exists(version_store):
+                link_or_copy(version_store, os.path.join(os.path.dirname(dst_member_fn), ".version." + os.path.basename(member_fn)))
+
+        f[1].data = data[selected]
+        f.writeto(dst_idx_fn, overwrite=True)
+
+    logger.info("%s: %s of %s members", os.path.basename(idx_fn), selected.sum(), len(selected))
+
+    return int(selected.sum()), len(selected)
+
+
+def master_file_name(suffix=None):
+    return "ic_master_file" + ("_" + suffix if suffix else "") + ".fits"
+
+
+def subset_tree(src_root, dst_root, ijd_start, ijd_stop, suffix=None):
+    """
+    Writes the subset of the tree with the master file of the given suffix into dst_root; returns, by index,
+    the number of (kept, all) members.
+    """
+    master_fn = os.path.join(src_root, "idx", "ic", master_file_name(suffix))
+    if not os.path.exists(master_fn):
+        raise FileNotFoundError("no master file %s in %s, give the suffix of the tree if it was built with one" % (
+            os.path.basename(master_fn), src_root))
+    master_dir = os.path.dirname(master_fn)
+
+    summary = {}
+    for location in group_locations(master_fn, MASTER_GROUP_EXT):
+        idx_fn = os.path.normpath(os.path.join(master_dir, location))
+        summary[os.path.basename(idx_fn)] = subset_index(src_root, dst_root, idx_fn, ijd_start, ijd_stop)
+
+    dst_master_fn = os.path.join(dst_root, os.path.relpath(master_fn, src_root))
+    os.makedirs(os.path.dirname(dst_master_fn), exist_ok=True)
+    shutil.copy2(master_fn, dst_master_fn)
+
+    for version_fn in ["idx/ic/version", "ic/ibis/version"]:
+        if os.path.exists(os.path.join(src_root, version_fn)):
+            os.makedirs(os.path.dirname(os.path.join(dst_root, version_fn)), exist_ok=True)
+            shutil.copy2(os.path.join(src_root, version_fn), os.path.join(dst_root, version_fn))
+
+    return summary
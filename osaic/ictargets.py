@@ -0,0 +1,68 @@
+"""
+Multi-target builds: many IC versions made from one scan of the candidate IC files.
+
+A build specification is a JSON file:
+
+    {
+     "base_location": "/data/ic_collection/bare",
+     "icfiles": ["ddcache/byrev/0052/.../isgr_rise_mod_0052.fits.gz", ...],
+     "from_file": ["candidates.txt"],
+     "targets": [
+        {"version": "dev221201-r0052", "revs": "52", "icfiles": ["isgr_arf_rsp_0052.fits"]},
+        {"version": "dev221201-rise", "patterns": ["*/ISGR_RISE_MOD_*"], "suffix": "rise"}
+     ]
+    }
+
+Each target takes the candidate files valid in its revolution range ("revs", by serial) and matching any of its
+"patterns", when given, followed by the files listed for the target itself. base_location and the candidate lists
+are optional.
+"""
+
+import fnmatch
+import json
+import logging
+
+from osaic.icsubset import parse_rev_range
+
+logger = logging.getLogger(__name__)
+
+
+def read_targets_spec(fn):
+    with open(fn) as f:
+        spec = json.load(f)
+
+    targets = spec.get('targets', [])
+    if len(targets) == 0:
+        raise ValueError("no targets in %s" % fn)
+
+    versions = [target.get('version') for target in targets]
+    if None in versions:
+        raise ValueError("every target in %s needs a version" % fn)
+    if len(set(versions)) != len(versions):
+        raise ValueError("duplicate target versions in %s" % fn)
+
+    return spec
+
+
+def select_target_files(target, candidates, scanned):
+    """
+    Candidate files for the target, in the given order; scanned maps each file to its members,
+    as (DS, version, serial, hashe, extension, digest). Indexed files are taken if any member is in the revolution range.
+    """
+    revs = target.get('revs')
+    if revs is not None:
+        rev_start, rev_stop = parse_rev_range(str(revs))
+
+    patterns = target.get('patterns')
+
+    selected = []
+    for fn in candidates:
+        if fn not in scanned:
+            continue
+        if revs is not None and not any(rev_start <= member[2] <= rev_stop for member in scanned[fn]):
+            continue
+        if patterns is not None and not any(fnmatch.fnmatch(fn, pattern) for pattern in patterns):
+            continue
+        selected.append(fn)
+
+    return selected
@@ -0,0 +1,227 @@
+"""
+Watching product directories for new IC files, e.g. per-revolution products appearing in ddcache/byrev.
+
+New files are collected as they appear and handed over in batches, once no new file arrived for the debounce time.
+inotify is used if the inotify_simple package is installed, otherwise the directories are polled.
+"""
+
+import fnmatch
+import logging
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATTERNS = ("*.fits", "*.fits.gz")
+MAX_ATTEMPTS = 3
+
+
+def matches(fn, patterns):
+    return any(fnmatch.fnmatch(os.path.basename(fn), pattern) for pattern in patterns)
+
+
+def walk_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            yield os.path.join(dirpath, name)
+
+
+class PollingWatcher:
+    """
+    Reports files which appeared or changed between two walks of the directories.
+    """
+
+    def __init__(self, directories, patterns=DEFAULT_PATTERNS, interval=10.):
+        self.directories = directories
+        self.patterns = patterns
+        self.interval = interval
+        self.known = self.snapshot()
+
+    def snapshot(self):
+        state = {}
+        for directory in self.directories:
+            for fn in walk_files(directory):
+                if not matches(fn, self.patterns):
+                    continue
+                try:
+                    st = os.stat(fn)
+                except FileNotFoundError:
+                    continue
+                state[fn] = (st.st_mtime_ns, st.st_size)
+        return state
+
+    def read_events(self, timeout=None):
+        time.sleep(self.interval)
+
+        current = self.snapshot()
+        new = [fn for fn, st in current.items() if self.known.get(fn) != st]
+        self.known = current
+
+        return new
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Reports files closed after writing or moved into the directories; new subdirectories are watched as they appear.
+    """
+
+    def __init__(self, directories, patterns=DEFAULT_PATTERNS):
+        if inotify_simple is None:
+            raise RuntimeError("inotify_simple is needed to watch with inotify")
+
+        self.patterns = patterns
+        self.inotify = inotify_simple.INotify()
+        self.watched = {}
+
+        for directory in directories:
+            self.add_tree(directory)
+
+    @property
+    def mask(self):
+        flags = inotify_simple.flags
+        return flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+
+    def add_tree(self, root):
+        """
+        Watches root and its subdirectories; returns files already there.
+        """
+        found = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            try:
+                self.watched[self.inotify.add_watch(dirpath, self.mask)] = dirpath
+            except FileNotFoundError:
+                continue
+            found.extend(os.path.join(dirpath, name) for name in filenames)
+        return found
+
+    def read_events(self, timeout=None):
+        flags = inotify_simple.flags
+        new = []
+
+        for event in self.inotify.read(timeout=None if timeout is None else int(timeout * 1000)):
+            if event.mask & flags.IGNORED:
+                self.watched.pop(event.wd, None)
+                continue
+
+            directory = self.watched.get(event.wd)
+            if directory is None:
+                continue
+            fn = os.path.join(directory, event.name)
+
+            if event.mask & flags.ISDIR:
+                # files may have been written before the watch was added
+                new.extend(found for found in self.add_tree(fn) if matches(found, self.patterns))
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO) and matches(fn, self.patterns):
+                new.append(fn)
+
+        return new
+
+    def close(self):
+        self.inotify.close()
+
+
+def make_watcher(directories, patterns=DEFAULT_PATTERNS, polling=False, interval=10.):
+    if polling or inotify_simple is None:
+        if not polling:
+            logger.warning("inotify_simple is not available, polling %s every %s s", directories, interval)
+        return PollingWatcher(directories, patterns, interval)
+    return InotifyWatcher(directories, patterns)
+
+
+def mtime_or_zero(fn):
+    try:
+        return os.path.getmtime(fn)
+    except FileNotFoundError:
+        return 0
+
+
+def apply_batch(callback, batch, failures, max_attempts=MAX_ATTEMPTS):
+    """
+    Applies the batch, or its files one by one if that fails, so that a file which can not be applied does not hold
+    back the others. callback may also return the files of the batch it could not apply. failures counts failed
+    attempts by file.
+
+    Returns files to retry; files are given up after max_attempts failed attempts.
+    """
+    try:
+        failed = list(callback(batch) or [])
+    except Exception as e:
+        logger.error("failed (%s) to apply %s new files", e, len(batch))
+        failed = None
+
+    if failed is None:
+        if len(batch) == 1:
+            failed = batch
+        else:
+            failed = []
+            for fn in batch:
+                try:
+                    failed.extend(callback([fn]) or [])
+                except Exception as e:
+                    logger.error("failed (%s) to apply %s", e, fn)
+                    failed.append(fn)
+
+    for fn in batch:
+        if fn not in failed:
+            failures.pop(fn, None)
+
+    retry = []
+    for fn in failed:
+        failures[fn] = failures.get(fn, 0) + 1
+        if failures[fn] >= max_attempts:
+            logger.error("giving up on %s after %s failed attempts", fn, failures.pop(fn))
+        else:
+            logger.warning("could not apply %s, will retry (%s of %s attempts)", fn, failures[fn], max_attempts)
+            retry.append(fn)
+
+    return retry
+
+
+def watch(watcher, callback, debounce=30., max_delay=600., stop=None, max_attempts=MAX_ATTEMPTS):
+    """
+    Calls callback with each batch of new files, oldest first, once no new file arrived for debounce seconds,
+    or at the latest max_delay seconds after the first file of the batch. Runs until stop() is true.
+
+    Files which could not be applied are retried debounce seconds later, with the next batch if any, up to
+    max_attempts times.
+    """
+    pending = {}
+    retry = []
+    failures = {}
+    first_event = last_event = last_attempt = None
+
+    while stop is None or not stop():
+        new = watcher.read_events(timeout=debounce)
+
+        now = time.monotonic()
+        if len(new) > 0:
+            logger.info("new files: %s", new)
+            if len(pending) == 0:
+                first_event = now
+            last_event = now
+            pending.update(dict.fromkeys(new))
+
+        if len(pending) > 0:
+            due = now - last_event >= debounce or now - first_event >= max_delay
+        else:
+            # retries do not wait for new files
+            due = len(retry) > 0 and now - last_attempt >= debounce
+
+        if due:
+            batch = sorted((fn for fn in pending if os.path.exists(fn)), key=mtime_or_zero)
+            pending.clear()
+
+            batch = [fn for fn in dict.fromkeys(retry + batch) if os.path.exists(fn)]
+            retry = []
+            if len(batch) > 0:
+                logger.info("applying %s new files", len(batch))
+                retry = apply_batch(callback, batch, failures, max_attempts)
+                last_attempt = time.monotonic()
@@ -4,6 +4,9 @@ from email.policy import default
 import glob
 
 import tempfile
+import functools
+import json
+import threading
 import os
 import re
 import subprocess
@@ -14,12 +17,24 @@ import logging
 import astropy.io.fits as fits
 import pilton
 import numpy as np
-from collections import defaultdict
 import timesystem
 from pathlib import Path
 
 import integral_site_config
 
+from osaic.icmaster import update_master, master_members, master_changes
+from osaic.icstructure import ICFile, ICStructures
+from osaic.icscan import ScanCache, scan_concurrently
+from osaic.icstore import split_icfile, extension_digests, run_parallel
+from osaic.icshard import parse_shard, shard_of, write_manifest, read_manifest, read_manifests, move_file
+from osaic.iclinks import link_file, link_tree, unshare_file, write_replacing
+from osaic.ictargets import read_targets_spec, select_target_files
+from osaic.icbundle import bundle_tree, ICBundle
+from osaic.icsubset import parse_rev_range, subset_tree
+from osaic.icmetrics import record_build, refresh_metrics, prometheus_text, metrics_json
+from osaic.icwatch import DEFAULT_PATTERNS, make_watcher, watch as watch_directories
+from osaic.icplan import COPY, SKIP, SUPERSEDED, COMPACTED, CREATE, RECREATE, KEEP, plan_totals, write_plan, read_plan, input_state, changed_inputs
+
 ic_collection = str(integral_site_config.settings.ic_collection) # type: str
 
 def remove_withtemplate(fn):
@@ -41,10 +56,47 @@ def remove_withtemplate(fn):
     except OSError:
         pass
 
+@functools.lru_cache(maxsize=100000)
+def ijd_to_rev(ijd):
+    return int(timesystem.converttime("IJD",ijd,"REVNUM"))
+
+
+@functools.lru_cache(maxsize=100000)
+def rev_to_ijd(rev):
+    return float(timesystem.converttime("REVNUM",rev,"IJD"))
+
+
+REVS_PER_SHARD=100
+
+
 class ICTree:
-    def __init__(self, icroot, master_suffix=""):
+    def __init__(self, icroot, master_suffix="", scan_cache=None, compact=False):
         self.icroot = icroot
         self.master_suffix = master_suffix
+        self.icstructures = ICStructures()
+        self.scan_cache = scan_cache
+        self.compact = compact
+        self.compacted = []
+        self.compacted_superseded = []
+        self.reference_root = None
+        self.heatool_calls = {}
+        self.scan_stats = dict(scanned=0, cached=0)
+        self.scan_stats_lock = threading.Lock()
+        self.plan_totals = None
+        self.shared_members = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.icstructures.clear()
+
+    def heatool(self,name):
+        self.heatool_calls[name]=self.heatool_calls.get(name,0)+1
+        return pilton.heatool(name)
 
     #@property
     def get_ibisicroot(self,DS):
@@ -85,29 +137,56 @@ class ICTree:
 
 
     def create_index_empty(self,DS):
-        dc=pilton.heatool("dal_create")
+        dc=self.heatool("dal_create")
         dc["obj_name"]=self.DS_to_idx_fn(DS)
         dc["template"]=DS+"-IDX.tpl"
         remove_withtemplate(dc["obj_name"].value+"("+dc["template"].value+")")
         dc.run()
         
     def get_file_DS(self,fn):
-        f=fits.open(fn)
+        with fits.open(fn) as f:
+            return self.get_hdulist_DS(f,fn)
+
+    def get_hdulist_DS(self,f,fn):
         if len(f)>2:
-            logging.warning("%s has too many extensions, probably index, and we refuse to deal with indexed IC ds, as they increase the amount of suffering in the world", fn)
+            logging.warning("%s has %i extensions: indexed IC files are scanned member by member, see get_hdulist_members", fn, len(f))
             raise Exception("too many extensions %i %s"%(len(f),repr(f)))
         if len(f)<2:
             logging.info("")
             raise Exception("too few extensions %i %s"%(len(f),repr(f)))
         return f[1].header['EXTNAME']
 
+    def is_grouping_header(self,header):
+        return header.get('EXTNAME','')=="GROUPING" or \
+               any(v in ('MEMBER_LOCATION','MEMBER_POSITION') for k,v in header.items() if k.startswith('TTYPE'))
+
+    def get_hdulist_members(self,f,fn):
+        """
+        member extensions of an indexed IC file, as (extension, DS); grouping extensions are skipped
+        """
+        members=[]
+        for ext in range(1,len(f)):
+            header=f[ext].header
+            if self.is_grouping_header(header):
+                logging.info("%s[%i] is a grouping table, skipping", fn, ext)
+                continue
+            if 'EXTNAME' not in header or 'VSTART' not in header:
+                logging.warning("%s[%i] is not an IC data structure, skipping", fn, ext)
+                continue
+            members.append((ext,header['EXTNAME']))
+
+        if len(members)==0:
+            raise Exception("no IC data structures in %s"%fn)
+
+        return members
+
 
     def attach_ds(self,fn,serial=0):
         DS=self.get_file_DS(fn)
         f_ds=fits.open(fn)
         f_ds.writeto(self.DS_to_fn(DS,serial),overwrite=True)
 
-        da=pilton.heatool("dal_attach")
+        da=self.heatool("dal_attach")
         da['Parent']=self.DS_to_idx_fn(DS)
         da['Child1']=self.DS_to_fn(DS,serial)
         da.run()
@@ -122,7 +201,7 @@ class ICTree:
 
         f_idx.writeto(da['Parent'].value,overwrite=True)
 
-        dv=pilton.heatool("dal_verify")
+        dv=self.heatool("dal_verify")
         dv["indol"]=self.DS_to_idx_fn(DS)
         dv['checksums']="yes"
         dv['backpointers']="yes"
@@ -131,37 +210,17 @@ class ICTree:
 
 
 
-    def init_icmaster(self):
-        #f=fits.open(self.get_icmaster("osa102"))
-        f=fits.open(self.icmaster)
-        
-        logging.info("ic master file starts with columns: %s", len(f[3].columns))
-
-        logging.debug([c.name for c in f[3].columns])
-
-        nhdu=fits.BinTableHDU.from_columns(f[3].columns+fits.ColDefs([
-            fits.Column(self.DS_to_mnemcol(DS),"1I") for DS in self.icstructures.keys()
-             if self.DS_to_mnemcol(DS) not in [c.name for c in f[3].columns]]))
-
-        for k,v in f[3].header.items():
-            if k.startswith("TFORM"): continue
-            if k.startswith("TTYPE"): continue
-            if k.startswith("TFIELDS"): continue
-            if k.startswith("NAXIS"): continue
-            #print ":",k,"x",v
-            nhdu.header[k]=v
-
+    def master_versions(self):
+        versions = {}
         for DS,icstructure in self.icstructures.items():
-            versions=sorted(set([icfile['version'] for icfile in icstructure]))
-            if len(versions)!=1:
-                raise Exception("inconsistent versions for "+DS+" "+repr(versions))
-            nhdu.data[0][self.DS_to_mnemcol(DS)]=versions[0]
-
-        f[3]=nhdu
+            ds_versions=sorted(set([icfile.version for icfile in icstructure]))
+            if len(ds_versions)!=1:
+                raise Exception("inconsistent versions for "+DS+" "+repr(ds_versions))
+            versions[self.DS_to_mnemcol(DS)]=ds_versions[0]
+        return versions
 
-        logging.info("ic master file complete with columns: %s", len(f[3].columns))
-
-        f.writeto(self.get_icmaster(self.master_suffix), overwrite=True)
+    def init_icmaster(self):
+        return update_master(self.icmaster, self.master_versions())
 
     def create_index_from_list(self,DS,fns=None,fns_list=None,update=True,recreate=True):
         if fns_list is None:
@@ -171,50 +230,67 @@ class ICTree:
             fns_list_handle,fns_list_fn=tempfile.mkstemp()
             logging.info("\n".join(fns))
             os.write(fns_list_handle, ("\n".join(fns)+"\n").encode())
+            os.close(fns_list_handle)
 
         else:
             if fns is not None:
                 raise Exception("what?")
+            fns_list_fn=fns_list
 
         logging.info("files: %s",fns)
 
-        idx_fn = self.DS_to_idx_fn(DS)
-        if os.path.exists(idx_fn):
-            if recreate:
-                os.remove(idx_fn)
-            else:
-                raise RuntimeError(f'index already exists, will not recreate: {idx_fn}')
-
-        da=pilton.heatool("txt2idx")
-        da['index']=idx_fn
-        da['template']=DS+"-IDX.tpl"
-        da['update']=1 if update else 0
-        da['element']=fns_list_fn
-        da.run()
-
-        f=fits.open(da['index'].value)
-        f[1].header['CREATOR']="Volodymyr Savchenko"
-        f[1].header['CONFIGUR']="dev"
-        f.writeto(da['index'].value,overwrite=True)
+        try:
+            idx_fn = self.DS_to_idx_fn(DS)
+            backpointers = {}
+            if os.path.exists(idx_fn):
+                if recreate:
+                    # keep the link to the master group, so that the recreated index does not need to be attached again
+                    with fits.open(idx_fn) as f_old:
+                        backpointers = {k: v for k, v in f_old[1].header.items() if k.startswith(("GRPID", "GRPLC"))}
+                    os.remove(idx_fn)
+                else:
+                    raise RuntimeError(f'index already exists, will not recreate: {idx_fn}')
+
+            da=self.heatool("txt2idx")
+            da['index']=idx_fn
+            da['template']=DS+"-IDX.tpl"
+            da['update']=1 if update else 0
+            da['element']=fns_list_fn
+            da.run()
+        finally:
+            # the list is only ours if we wrote it; a resident service would otherwise accumulate them
+            if fns_list is None:
+                os.remove(fns_list_fn)
+
+        with fits.open(da['index'].value, mode="update") as f:
+            f[1].header['CREATOR']="Volodymyr Savchenko"
+            f[1].header['CONFIGUR']="dev"
+            for k, v in backpointers.items():
+                f[1].header[k]=v
+
+        return backpointers
+
+    def is_attached_to_master(self,DS,members=None):
+        if members is None:
+            members=master_members(self.icmaster)
+        return os.path.normpath(os.path.abspath(self.DS_to_idx_fn(DS))) in members
 
     def attach_idx_to_master(self,DS):
-        da=pilton.heatool("dal_attach")
+        da=self.heatool("dal_attach")
         da['Parent']=self.icmaster+"[2]"
         da['Child1']=self.DS_to_idx_fn(DS)
         da.run()
 
-    icstructures=defaultdict(list)
-
     def get_icfile_validity_rev(self,f,unique=True,first=True,middle=False):
         vstart=self.find_key(f,"VSTART")
         vstop=self.find_key(f,"VSTOP")
 
-        rev_start=int(timesystem.converttime("IJD",vstart,"REVNUM"))
+        rev_start=ijd_to_rev(vstart)
 
         if first:
             return rev_start
         
-        rev_stop=int(timesystem.converttime("IJD",vstop,"REVNUM"))
+        rev_stop=ijd_to_rev(vstop)
 
         if middle:
             return round(0.5*(rev_start+rev_stop))
@@ -246,56 +322,574 @@ class ICTree:
             raise Exception("this file has no versions")
         return values_unique[0]
 
-    def add_icfile(self,icfile):
-        logging.info("requested to add %s", icfile)
-        DS=self.get_file_DS(icfile)
-        logging.info("%s as %s", icfile, DS)
+    def scan_icfile(self,icfile):
+        if self.scan_cache is not None:
+            scanned=self.scan_cache.get(icfile)
+            # compaction needs digests, which are not computed by every scan
+            if scanned is not None and not (self.compact and any(member[5] is None for member in scanned)):
+                logging.info("%s as %s (cached)", icfile, ", ".join(member[0] for member in scanned))
+                with self.scan_stats_lock:
+                    self.scan_stats['cached']+=1
+                return scanned
+
+        with self.scan_stats_lock:
+            self.scan_stats['scanned']+=1
 
         hash_fn=os.path.dirname(os.path.abspath(icfile))+"/hash.txt"
-        if os.path.exists(hash_fn):
-            hashe=open(hash_fn).read()
-        else:
+        try:
+            with open(hash_fn) as f_hash:
+                hashe=f_hash.read()
+        except FileNotFoundError:
             hashe=""
 
-        f=fits.open(icfile)
-        rev=self.get_icfile_validity_rev(f)
+        with fits.open(icfile) as f:
+            if len(f)>2:
+                members=[]
+                for ext,DS in self.get_hdulist_members(f,icfile):
+                    logging.info("%s[%i] as %s", icfile, ext, DS)
+                    members.append((DS, self.find_version([f[ext]]), self.get_icfile_validity_rev([f[ext]]), ext))
+            else:
+                DS=self.get_hdulist_DS(f,icfile)
+                logging.info("%s as %s", icfile, DS)
+                members=[(DS, self.find_version(f), self.get_icfile_validity_rev(f), None)]
 
-        if rev<0 or rev>9000: # over 9000!!
-            serial=1
+        if self.compact:
+            digests=extension_digests(icfile, set(extension or 1 for DS, version, rev, extension in members))
         else:
-            serial=rev
+            digests={}
+
+        scanned=[]
+        used=set()
+        for DS, version, rev, extension in members:
+            serial=self.serial_of_rev(rev)
+
+            if extension is not None:
+                # all members of an indexed file are kept: members starting in the same revolution take the next serials
+                while (DS,serial) in used:
+                    serial+=1
+                used.add((DS,serial))
+
+            scanned.append((DS, version, serial, hashe, extension, digests.get(extension or 1)))
 
-        self.icstructures[DS].append(dict(
+        if self.scan_cache is not None:
+            self.scan_cache.put(icfile, scanned)
+
+        return scanned
+
+    def serial_of_rev(self,rev):
+        if rev<0 or rev>9000: # over 9000!!
+            return 1
+        return rev
+
+    def is_moved_member(self,icfile):
+        """
+        whether icfile is a member of an indexed file stored under a later serial than its own revolution, see scan_icfile
+        """
+        if icfile.extension is None or not os.path.exists(icfile.origin_filename):
+            return False
+        with fits.open(icfile.origin_filename) as f:
+            return self.serial_of_rev(self.get_icfile_validity_rev([f[icfile.extension]]))!=icfile.serial
+
+    def check_collision(self,ic_store_filename,icfiles):
+        """
+        records stored under the same serial supersede each other, as a newer file of the same revolution should;
+        a member moved to a later serial would instead silently replace the member of another revolution
+        """
+        for icfile in icfiles:
+            others=[other for other in icfiles if (other.origin_filename,other.extension)!=(icfile.origin_filename,icfile.extension)]
+            if len(others)>0 and self.is_moved_member(icfile):
+                raise Exception("%s[%i] was moved to serial %i, stored as %s, which is also taken by %s: "
+                                "members of indexed files starting in the same revolution collide with other inputs"%(
+                                    icfile.origin_filename, icfile.extension, icfile.serial, ic_store_filename,
+                                    ", ".join(sorted(set(other.origin_filename for other in others)))))
+
+    def member_rev(self,icfile):
+        with fits.open(self.existing_path(icfile.origin_filename)) as f:
+            return self.get_icfile_validity_rev([f[icfile.extension or 1]])
+
+    def check_replaced(self,DS,icfiles,replaced):
+        """
+        as check_collision, for indexed members replaced in an incremental update: when either the new or the indexed
+        member is moved, only the member of the same revolution may be replaced, e.g. when an indexed file is applied again
+        """
+        by_serial=dict((icfile.serial,icfile) for icfile in replaced)
+        for icfile in icfiles:
+            if icfile.serial not in by_serial:
+                continue
+            indexed=by_serial[icfile.serial]
+
+            rev=self.member_rev(icfile)
+            indexed_rev=self.member_rev(indexed)
+            moved=self.serial_of_rev(rev)!=icfile.serial or self.serial_of_rev(indexed_rev)!=icfile.serial
+            if moved and rev!=indexed_rev:
+                raise Exception("%s%s, starting in revolution %i, would replace the indexed member %s of DS %s, "
+                                "starting in revolution %i: members of indexed files starting in the same revolution "
+                                "are moved to later serials and collide with other inputs"%(
+                                    icfile.origin_filename, "" if icfile.extension is None else "[%i]"%icfile.extension,
+                                    rev, indexed.ic_store_filename, DS, indexed_rev))
+
+    def add_icfile(self,icfile,scanned=None):
+        logging.info("requested to add %s", icfile)
+        if scanned is None:
+            scanned=self.scan_icfile(icfile)
+
+        return [self.icstructures.add(DS, ICFile(
                     origin_filename=icfile,
-                    version=self.find_version(f),
+                    version=version,
                     serial=serial,
                     hashe=hashe,
+                    extension=extension,
+                    digest=digest,
                     ))
+                for DS, version, serial, hashe, extension, digest in scanned]
+
+    def add_icfiles(self,icfiles,concurrency=16):
+        """
+        scans files concurrently, and adds them in the order given; returns files which could not be added
+        """
+        icfiles=[icfile for icfile in icfiles]
+        failed=[]
+        for icfile, scanned in zip(icfiles, scan_concurrently(self.scan_icfile, icfiles, concurrency)):
+            if isinstance(scanned, Exception):
+                logging.error("failed (%s) to add %s", scanned, icfile)
+                failed.append(icfile)
+            else:
+                self.add_icfile(icfile,scanned)
+        return failed
+
+    def version_store_fn(self,ic_store_filename):
+        return os.path.dirname(os.path.abspath(ic_store_filename))+"/.version."+os.path.basename(ic_store_filename)
+
+    def version_store_content(self,icfile):
+        # a member stored with extended validity differs from the same input stored as is
+        if icfile.vstop is None:
+            return icfile.hashe
+        return "%s VSTOP=%s"%(icfile.hashe,icfile.vstop)
+
+    def shared_key(self,icfile,ic_store_filename):
+        return (os.path.abspath(icfile.origin_filename), os.path.relpath(ic_store_filename, self.icroot), self.version_store_content(icfile))
+
+    def store_icfile_members(self,members):
+        """
+        stores records [(DS, icfile), ...] made from one input file, reading it once
+        """
+        origin_filename=members[0][1].origin_filename
+        targets={}
+
+        for DS,icfile in members:
+            ic_store_filename=self.DS_to_fn(DS,serial=icfile.serial)
+            logging.info("store %s%s in IC as %s", origin_filename, "" if icfile.extension is None else "[%i]"%icfile.extension, ic_store_filename)
+
+            # the same input is stored identically in other trees of a multi-target build, unless its validity was extended
+            shared_key=self.shared_key(icfile,ic_store_filename)
+            shared=None if self.shared_members is None else self.shared_members.get(shared_key)
+
+            if shared is not None and os.path.exists(shared):
+                logging.info("linking %s stored in %s", ic_store_filename, shared)
+                link_file(shared, ic_store_filename)
+                icfile.size=os.path.getsize(ic_store_filename)
+            elif icfile.extension is None:
+                # single IC files are valid until superseded by the next one
+                targets[1]=(ic_store_filename, {'VSTOP': 99999})
+            else:
+                # members of indexed files keep their own validity, unless extended by compaction
+                targets[icfile.extension]=(ic_store_filename, {} if icfile.vstop is None else {'VSTOP': icfile.vstop})
 
-    def write(self):
+        if len(targets)>0:
+            sizes=split_icfile(origin_filename, targets)
+        else:
+            sizes={}
+
+        for DS,icfile in members:
+            ic_store_filename=self.DS_to_fn(DS,serial=icfile.serial)
+            if ic_store_filename in sizes:
+                icfile.size=sizes[ic_store_filename]
+                if self.shared_members is not None:
+                    self.shared_members[self.shared_key(icfile,ic_store_filename)]=ic_store_filename
+
+            version_store=self.version_store_fn(ic_store_filename)
+            logging.info("version store %s", version_store)
+            write_replacing(version_store, self.version_store_content(icfile))
+            icfile.ic_store_filename=ic_store_filename
+            icfile.version_store=version_store
+
+        return [icfile for DS,icfile in members]
+
+    def store_icfile(self,DS,icfile):
+        return self.store_icfile_members([(DS,icfile)])[0]
+
+    def store_by_origin(self,members,workers=4):
+        by_origin={}
+        for DS,icfile in members:
+            by_origin.setdefault(icfile.origin_filename,[]).append((DS,icfile))
+        run_parallel(self.store_icfile_members, by_origin.values(), workers)
+
+    def store_icfiles(self,workers=4):
+        stored={}
+        for DS,icfiles in self.icstructures.items():
+            for icfile in icfiles:
+                ic_store_filename=self.DS_to_fn(DS,serial=icfile.serial)
+                if ic_store_filename in stored:
+                    superseded=stored[ic_store_filename][1]
+                    self.check_collision(ic_store_filename,[superseded,icfile])
+                    logging.warning("%s and %s are both stored as %s, keeping the latter", superseded.origin_filename, icfile.origin_filename, ic_store_filename)
+                    superseded.size=0
+                    superseded.ic_store_filename=ic_store_filename
+                stored[ic_store_filename]=(DS,icfile)
+
+        self.store_by_origin(stored.values(), workers)
+
+    def select_shard(self,shard,n_shards,revs_per_shard=REVS_PER_SHARD):
+        selected=ICStructures()
+        for DS,icfiles in self.icstructures.items():
+            for icfile in icfiles:
+                if shard_of(DS,icfile.serial,n_shards,revs_per_shard)==shard:
+                    selected.add(DS,icfile)
+        logging.info("shard %s/%s selected %s of %s files", shard, n_shards, selected.n_files(), self.icstructures.n_files())
+        self.icstructures=selected
+
+    def write_shard(self,shard,n_shards,revs_per_shard=REVS_PER_SHARD,store_workers=4):
+        for DS in self.icstructures:
+            os.makedirs(self.get_ibisicroot(DS), exist_ok=True)
+
+        self.store_icfiles(store_workers)
+
+        entries=[]
+        for DS,icfiles in self.icstructures.items():
+            for icfile in icfiles:
+                entry=icfile.as_dict()
+                entry['DS']=DS
+                entry['stored']=os.path.relpath(icfile.ic_store_filename, self.icroot)
+                entries.append(entry)
+
+        write_manifest(self.icroot, shard, n_shards, revs_per_shard, entries)
+
+    def merge_shard(self,shard_dir,manifest=None):
+        if manifest is None:
+            manifest=read_manifest(shard_dir)
+        logging.info("merging shard %s/%s from %s", manifest['shard'], manifest['n_shards'], shard_dir)
+
+        for entry in manifest['files']:
+            DS=entry['DS']
+            icfile=ICFile.from_dict(entry)
+            ic_store_filename=self.DS_to_fn(DS,serial=icfile.serial)
+
+            stored=os.path.join(shard_dir, entry['stored'])
+            if os.path.exists(stored):
+                os.makedirs(os.path.dirname(ic_store_filename), exist_ok=True)
+                move_file(stored, ic_store_filename)
+                move_file(self.version_store_fn(stored), self.version_store_fn(ic_store_filename))
+
+            icfile.ic_store_filename=ic_store_filename
+            icfile.version_store=self.version_store_fn(ic_store_filename)
+            self.icstructures.add(DS,icfile)
+
+    def existing_path(self,fn):
+        """
+        where fn is found now: in the tree, or in the reference tree it will be cloned from
+        """
+        if self.reference_root is None or os.path.exists(fn):
+            return fn
+        return os.path.join(self.reference_root, os.path.relpath(fn, self.icroot))
+
+    def tree_path(self,fn):
+        """
+        where fn, found in the reference tree, will be in the tree
+        """
+        if self.reference_root is None:
+            return fn
+        relpath=os.path.relpath(fn, self.reference_root)
+        if relpath.startswith(".."):
+            return fn
+        return os.path.normpath(os.path.join(os.path.abspath(self.icroot), relpath))
+
+    def is_stored(self,ic_store_filename,hashe):
+        if hashe == "" or not os.path.exists(self.existing_path(ic_store_filename)):
+            return False
+        try:
+            with open(self.existing_path(self.version_store_fn(ic_store_filename))) as f:
+                return f.read() == hashe
+        except FileNotFoundError:
+            return False
+
+    def has_backpointers(self,DS):
+        idx_fn=self.existing_path(self.DS_to_idx_fn(DS))
+        if not os.path.exists(idx_fn):
+            return False
+        with fits.open(idx_fn) as f:
+            return any(k.startswith("GRPID") for k in f[1].header.keys())
+
+    def index_members(self,DS):
+        idx_fn=self.existing_path(self.DS_to_idx_fn(DS))
+        if not os.path.exists(idx_fn):
+            return None
+        with fits.open(idx_fn) as f:
+            return set(os.path.basename(str(m).strip()) for m in f[1].data['MEMBER_LOCATION'])
+
+    def indexed_icfiles(self,DS):
+        """
+        members of the current index of DS, as records stored in place
+        """
+        idx_fn=self.existing_path(self.DS_to_idx_fn(DS))
+        if not os.path.exists(idx_fn):
+            return []
+
+        icfiles=[]
+        with fits.open(idx_fn) as f:
+            data=f[1].data
+            for i,location in enumerate(data['MEMBER_LOCATION']):
+                ic_store_filename=os.path.join(self.get_ibisicroot(DS),os.path.basename(str(location).strip()))
+                serial=re.search(r"_(\d+)\.fits$",ic_store_filename)
+                if serial is None:
+                    logging.warning("%s is not stored as a serial member of %s, not keeping it", ic_store_filename, DS)
+                    continue
+
+                try:
+                    with open(self.existing_path(self.version_store_fn(ic_store_filename))) as f_version:
+                        hashe=f_version.read()
+                except FileNotFoundError:
+                    hashe=""
+
+                if 'VERSION' in data.columns.names:
+                    version=int(data['VERSION'][i])
+                else:
+                    with fits.open(self.existing_path(ic_store_filename)) as f_member:
+                        version=self.find_version(f_member)
+
+                icfile=ICFile(
+                        origin_filename=ic_store_filename,
+                        version=version,
+                        serial=int(serial.group(1)),
+                        hashe=hashe,
+                        )
+                icfile.ic_store_filename=ic_store_filename
+                icfiles.append(icfile)
+
+        return icfiles
+
+    def add_index_members(self):
+        """
+        keeps members already in the indices of the DS being added to, for incremental updates;
+        added files replace indexed members stored under the same serial
+        """
+        updated=ICStructures()
+        for DS,icfiles in self.icstructures.items():
+            serials=set(icfile.serial for icfile in icfiles)
+            indexed=self.indexed_icfiles(DS)
+            self.check_replaced(DS,icfiles,[icfile for icfile in indexed if icfile.serial in serials])
+            kept=[icfile for icfile in indexed if icfile.serial not in serials]
+            for icfile in sorted(kept+icfiles, key=lambda icfile: icfile.serial):
+                updated.add(DS,icfile)
+        logging.info("kept %s indexed members", updated.n_files()-self.icstructures.n_files())
+        self.icstructures=updated
+
+    def member_vstart(self,icfile):
+        with fits.open(icfile.origin_filename) as f:
+            return f[icfile.extension or 1].header['VSTART']
+
+    def member_vstop(self,icfile):
+        if icfile.extension is None:
+            return 99999
+        if icfile.vstop is not None:
+            return icfile.vstop
+        with fits.open(icfile.origin_filename) as f:
+            return f[icfile.extension].header['VSTOP']
+
+    def compact_members(self):
+        """
+        drops members with the same content and version as the previous member of their DS, extending the validity
+        of the previous member instead; members without digests, or starting after the previous member stops,
+        are kept. Records superseded by a dropped member are dropped with it. Returns the number of dropped members.
+        """
+        self.compacted=[]
+        self.compacted_superseded=[]
+        compacted=ICStructures()
+
+        for DS,icfiles in self.icstructures.items():
+            # the last record stored under each serial is the one in effect
+            latest={}
+            for icfile in icfiles:
+                latest[icfile.serial]=icfile
+
+            dropped=set()
+            dropped_serials={}
+            previous=None
+            for icfile in sorted(latest.values(), key=lambda icfile: icfile.serial):
+                if previous is not None and icfile.digest is not None and \
+                        icfile.digest==previous.digest and icfile.version==previous.version and \
+                        self.member_vstop(previous)>=self.member_vstart(icfile):
+                    logging.info("%s is the same as %s, compacting", icfile.origin_filename, previous.origin_filename)
+                    if previous.extension is not None:
+                        # single IC files are valid until superseded, members of indexed files need a new VSTOP
+                        previous.vstop=self.member_vstop(icfile)
+                    self.compacted.append((DS,icfile,previous))
+                    dropped.add(id(icfile))
+                    dropped_serials[icfile.serial]=previous
+                else:
+                    previous=icfile
+
+            for icfile in icfiles:
+                if id(icfile) in dropped:
+                    continue
+                if icfile.serial in dropped_serials:
+                    logging.info("%s is superseded by a compacted member, dropping it", icfile.origin_filename)
+                    self.compacted_superseded.append((DS,icfile,dropped_serials[icfile.serial]))
+                    continue
+                compacted.add(DS,icfile)
+
+        logging.info("compacted %s of %s members", len(self.compacted), self.icstructures.n_files())
+        self.icstructures=compacted
+
+        return len(self.compacted)
+
+    def plan(self):
+        by_store={}
+        for DS,icfiles in self.icstructures.items():
+            for icfile in icfiles:
+                by_store.setdefault(self.DS_to_fn(DS,serial=icfile.serial),[]).append((DS,icfile))
+
+        n_members={}
+        for DS,icfile in [entry for entries in by_store.values() for entry in entries]+ \
+                [(DS,icfile) for DS,icfile,kept in self.compacted+self.compacted_superseded]:
+            n_members[icfile.origin_filename]=n_members.get(icfile.origin_filename,0)+1
+
+        files=[]
+        collisions=[]
+        for ic_store_filename,entries in by_store.items():
+            if len(entries)>1:
+                self.check_collision(ic_store_filename,[icfile for DS,icfile in entries])
+                collisions.append(dict(
+                    DS=entries[-1][0],
+                    ic_store_filename=ic_store_filename,
+                    origin_filenames=[icfile.origin_filename for DS,icfile in entries],
+                ))
+
+            for i,(DS,icfile) in enumerate(entries):
+                if i<len(entries)-1:
+                    action=SUPERSEDED
+                elif icfile.origin_filename==ic_store_filename or \
+                        (icfile.hashe!="" and self.is_stored(ic_store_filename,self.version_store_content(icfile))):
+                    action=SKIP
+                else:
+                    action=COPY
+
+                entry=icfile.as_dict()
+                entry.update(
+                    DS=DS,
+                    ic_store_filename=ic_store_filename,
+                    action=action,
+                    bytes=os.path.getsize(self.existing_path(icfile.origin_filename))//n_members[icfile.origin_filename],
+                    **input_state(self.existing_path(icfile.origin_filename))
+                )
+                files.append(entry)
+
+        # records dropped by compaction are in effect stored as the member kept in their place
+        for DS,icfile,kept,action in [compacted+(COMPACTED,) for compacted in self.compacted]+ \
+                [superseded+(SUPERSEDED,) for superseded in self.compacted_superseded]:
+            entry=icfile.as_dict()
+            entry.update(
+                DS=DS,
+                ic_store_filename=self.DS_to_fn(DS,serial=kept.serial),
+                action=action,
+                bytes=os.path.getsize(self.existing_path(icfile.origin_filename))//n_members[icfile.origin_filename],
+                **input_state(self.existing_path(icfile.origin_filename))
+            )
+            files.append(entry)
+
+        attached=set(self.tree_path(member) for member in master_members(self.existing_path(self.icmaster)))
+        indices=[]
+        for DS in self.icstructures:
+            members=[f['ic_store_filename'] for f in files if f['DS']==DS and f['action'] not in (SUPERSEDED, COMPACTED)]
+            existing=self.index_members(DS)
+            if existing is None:
+                action=CREATE
+            elif any(f['action']==COPY for f in files if f['DS']==DS) or existing!=set(os.path.basename(m) for m in members):
+                action=RECREATE
+            else:
+                action=KEEP
+
+            indices.append(dict(
+                DS=DS,
+                index=self.DS_to_idx_fn(DS),
+                action=action,
+                members=members,
+                # recreated indices keep their backpointers to the master, new ones need attaching
+                attach=not (self.is_attached_to_master(DS,attached) and self.has_backpointers(DS)),
+            ))
+
+        with fits.open(self.existing_path(self.icmaster)) as f:
+            new_columns,changed=master_changes(f,self.master_versions())
+
+        plan=dict(
+            icroot=self.icroot,
+            master_suffix=self.master_suffix,
+            files=files,
+            collisions=collisions,
+            indices=indices,
+            master=dict(new_columns=new_columns, changed=changed),
+        )
+        plan['totals']=plan_totals(plan)
+
+        return plan
+
+    def execute_plan(self,plan,store_workers=4):
+        # decisions and figures of a plan made earlier hold only for the inputs it was made from
+        changed=changed_inputs(plan['files'],self.existing_path)
+        if len(changed)>0:
+            raise Exception("%s input files changed since the plan was made, e.g. %s: make a new plan"%(len(changed),changed[0]))
+
+        self.plan_totals=plan['totals']
+
+        for collision in plan['collisions']:
+            logging.warning("%s are all stored as %s, keeping the last", collision['origin_filenames'], collision['ic_store_filename'])
+
+        self.icstructures=ICStructures()
+        to_copy=[]
+        for entry in plan['files']:
+            icfile=self.icstructures.add(entry['DS'],ICFile.from_dict(entry))
+            icfile.ic_store_filename=entry['ic_store_filename']
+            if entry['action']==COPY:
+                to_copy.append((entry['DS'],icfile))
+            elif entry['action']==SKIP:
+                logging.info("already stored: %s", icfile.ic_store_filename)
+                icfile.size=os.path.getsize(icfile.ic_store_filename)
+                icfile.version_store=self.version_store_fn(icfile.ic_store_filename)
+            else:
+                icfile.size=0
+
+        if plan['totals']['nothing_to_do']:
+            logging.info("nothing to do in %s", self.icroot)
+            return
+
+        logging.info("storing %s files, %.5lg Mb", len(to_copy), plan['totals']['bytes']/1024./1024.)
+        self.store_by_origin(to_copy, store_workers)
+
+        self.write_indices(
+                set(index['DS'] for index in plan['indices'] if index['action']!=KEEP),
+                attach={index['DS']: index['attach'] for index in plan['indices']},
+                )
+
+    def write(self,store_workers=4):
+        self.execute_plan(self.plan(),store_workers)
+
+    def write_indices(self,DSs=None,attach=None):
+        """
+        writes indices of DSs (all by default); attach maps DS to whether the index is attached to the master,
+        as decided by the plan, otherwise it is decided here
+        """
+        # the master is updated in place, and may be linked from the base tree
+        unshare_file(self.icmaster)
         self.init_icmaster()
+        attached=master_members(self.icmaster)
 
         for DS,icfiles in self.icstructures.items():
+            if DSs is not None and DS not in DSs:
+                logging.info("%s index unchanged", DS)
+                continue
+
             logging.info("%s", DS)
 
-            filelist=[]
-            for icfile in icfiles:
-                logging.info("IC file %s", icfile)
-                ic_store_filename=self.DS_to_fn(DS,serial=icfile['serial'])
-                logging.info("store in IC as %s", ic_store_filename)
-
-                f_ds=fits.open(icfile['origin_filename'])
-                f_ds[1].header['VSTOP']=99999
-                f_ds.writeto(ic_store_filename,overwrite=True)
-
-                version_store=os.path.dirname(os.path.abspath(ic_store_filename))+"/.version."+os.path.basename(ic_store_filename)
-                logging.info("version store %s", version_store)
-                open(version_store,"w").write(icfile['hashe'])
-                icfile['size']=os.path.getsize(ic_store_filename)
-                icfile['ic_store_filename']=ic_store_filename
-                icfile['version_store']=version_store
-    
-                filelist.append(ic_store_filename)
+            filelist=[ic_store_filename for ic_store_filename in dict.fromkeys(icfile.ic_store_filename for icfile in icfiles)]
 
             logging.info("file list %s", filelist)
 
@@ -303,18 +897,43 @@ class ICTree:
             if os.path.exists(idx_fn):
                 logging.info("index exists: %s OVERWRITING", idx_fn)
 
-            self.create_index_from_list(DS,fns=filelist)
-            self.attach_idx_to_master(DS)
+            backpointers=self.create_index_from_list(DS,fns=filelist)
+            if attach is not None:
+                attach_DS=attach[DS]
+            else:
+                attach_DS=len(backpointers)==0 or not self.is_attached_to_master(DS,attached)
+
+            if attach_DS:
+                self.attach_idx_to_master(DS)
+            else:
+                logging.info("index already attached to master: %s", idx_fn)
 
-            self.write_version()
+        self.write_version()
 
     def write_version(self):
-        open(self.icroot+"/idx/ic/version","w").write(time.strftime("%Y-%m-%dT%H:%M:%S"))
-        open(self.icroot+"/ic/ibis/version","w").write(time.strftime("%Y-%m-%dT%H:%M:%S"))
+        write_replacing(self.icroot+"/idx/ic/version",time.strftime("%Y-%m-%dT%H:%M:%S"))
+        write_replacing(self.icroot+"/ic/ibis/version",time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+    def report(self):
+        return dict(
+            icroot=self.icroot,
+            master_suffix=self.master_suffix,
+            heatool_calls=self.heatool_calls,
+            scan=self.scan_stats,
+            plan_totals=self.plan_totals,
+            DS={
+                DS: dict(
+                    n_files=sum(1 for k in icfiles if k.size),
+                    size=sum([k.size or 0 for k in icfiles]),
+                    version=sorted(set([k.version for k in icfiles])),
+                )
+                for DS,icfiles in self.icstructures.items()
+            }
+        )
 
     def summarize(self):
         for DS,icfiles in self.icstructures.items():
-            logging.info("%s %s %s %s", DS,len(icfiles),"%.5lg"%(sum([k['size'] for k in icfiles])/1024./1024.),"Mb")
+            logging.info("%s %s %s %s", DS,len(icfiles),"%.5lg"%(sum([k.size or 0 for k in icfiles])/1024./1024.),"Mb")
 
 
 @click.group()
@@ -349,10 +968,23 @@ def list():
         logger.info("ic_version: %s", ic_version)
 
 
+def ic_master_fn(ic):
+    return Path(ic_collection) / Path(ic) / "idx/ic/ic_master_file.fits"
+
+
+def read_ic_master(ic):
+    with fits.open(ic_master_fn(ic)) as icm:
+        config=icm[3].data[0]
+        return dict(
+            members=[str(m).strip() for m in icm[2].data['MEMBER_LOCATION']] if 'MEMBER_LOCATION' in icm[2].columns.names else [],
+            versions={name: config[name].item() for name in icm[3].columns.names},
+        )
+
+
 @cli.command()
 @click.argument('ic')
 def inspect(ic):
-    icm = fits.open(Path(ic_collection) / Path(ic) / "idx/ic/ic_master_file.fits")
+    icm = fits.open(ic_master_fn(ic))
 
     print(icm[1].data)
 
@@ -360,31 +992,44 @@ def inspect(ic):
 
     print(icm[3].data)
 
-@cli.command()
-@click.argument('ic_path')
-@click.argument('ext_name')
-def ic_find(ic_path, ext_name):
+
+def find_ic(ic_path, ext_name, sub_index="sub_index.fits"):
     ic_find = pilton.heatool('ic_find')
     print(ic_find)
 
-    ic_find['icConfig'] = Path(ic_collection) / ic_path / 'idx/ic/ic_master_file.fits'
+    ic_find['icConfig'] = ic_master_fn(ic_path)
     ic_find['extname'] = ext_name
     ic_find['aliasRef'] = 'OSA'
-    ic_find['subIndex'] = "sub_index.fits"
+    ic_find['subIndex'] = sub_index
 
     ic_find.run()
 
+    return sub_index
+
 
 @cli.command()
-@click.argument('icfiles', nargs=-1)
-@click.option('-f', '--from-file', multiple=True)
-@click.option('-s', '--suffix')
-@click.option('-c', '--overwrite-index', is_flag=True)
-@click.option('-v', '--version', default=None)
-@click.option('-i', '--in-place', is_flag=True, default=False)
-@click.option('-b', '--base-location', default=None)
-def create(icfiles, from_file, suffix, overwrite_index, base_location, in_place, version):
+@click.argument('ic_path')
+@click.argument('ext_name')
+def ic_find(ic_path, ext_name):
+    find_ic(ic_path, ext_name)
+
+
+def collect_icfiles(icfiles=(), from_file=()):
+    collected = []
 
+    for fn in from_file:
+        logging.info("from %s",fn)
+        with open(fn) as f:
+            for icfile in f:
+                if icfile.strip() != "":
+                    collected.append(icfile.strip())
+
+    collected.extend(icfiles)
+
+    return collected
+
+
+def resolve_ic_root(base_location=None, in_place=False, version=None):
     if ic_collection is None:
         logger.error("IC_COLLECTION is needed")
         raise RuntimeError("IC_COLLECTION is needed")
@@ -405,39 +1050,371 @@ def create(icfiles, from_file, suffix, overwrite_index, base_location, in_place,
         base_location = os.path.join(ic_collection, "bare")
 
     logging.info('will use base location: %s', base_location)
-    logger.warn('output IC root: %s', tmp_ic_root)
+    logger.warning('output IC root: %s', tmp_ic_root)
 
-    if not in_place:
-        subprocess.check_call(["rsync", "-avu", 
+    return tmp_ic_root, base_location
+
+
+def clone_ic_root(base_location, tmp_ic_root):
+    subprocess.check_call(["rsync", "-avu", 
                            base_location + "/",
                            tmp_ic_root+"/",
                            ])
 
-    ictree = ICTree(tmp_ic_root, suffix or "")
 
-    for fn in from_file:
-        logging.info("from %s",fn)
-        with open(fn) as f:
-            for icfile in f:
-                try:
-                    ictree.add_icfile(icfile.strip())
-                except Exception as e:
-                    logging.error("failed (%s) to add %s: %s from list file %s", e, icfile.strip(), fn)
+def prepare_ic_root(base_location=None, in_place=False, version=None):
+    tmp_ic_root, base_location = resolve_ic_root(base_location, in_place, version)
+
+    if not in_place:
+        clone_ic_root(base_location, tmp_ic_root)
+
+    return tmp_ic_root
+
+
+def metrics_dir():
+    return os.path.join(ic_collection, ".metrics")
+
 
-    for icfile in icfiles:
+def finish_report(report, started, record_metrics=True):
+    report['version'] = os.path.basename(os.path.normpath(report['icroot']))
+    report['started'] = started
+    report['finished'] = time.time()
+    report['duration'] = report['finished'] - started
+
+    if record_metrics:
         try:
-            ictree.add_icfile(icfile)
+            record_build(metrics_dir(), report)
         except Exception as e:
-            logging.error("failed (%s) to add %s", e, icfile)
+            logging.error("failed (%s) to record build metrics in %s", e, metrics_dir())
+
+    return report
+
+
+def build_ic_version(icfiles=(), from_file=(), suffix=None, base_location=None, in_place=False, version=None, scan_cache=None, scan_concurrency=16, store_workers=4,
+                     plan_fn=None, plan_only=False, record_metrics=True, compact=False):
+    started = time.time()
+    tmp_ic_root, base_location = resolve_ic_root(base_location, in_place, version)
+
+    with ICTree(tmp_ic_root, suffix or "", scan_cache=scan_cache, compact=compact) as ictree:
+        ictree.add_icfiles(collect_icfiles(icfiles, from_file), concurrency=scan_concurrency)
+        if compact:
+            ictree.compact_members()
+
+        if not in_place:
+            # the tree is not cloned yet: compare with what it will be cloned from
+            ictree.reference_root = base_location
+
+        plan = ictree.plan()
+        plan['clone'] = None if in_place else dict(base_location=base_location)
+        logging.info("build plan totals: %s", plan['totals'])
 
-    ictree.write()
-    ictree.summarize()
+        if plan_fn is not None:
+            write_plan(plan, plan_fn)
 
-    # if version is None:
-    #     logging.info("version auto-generated: moving (will be)")
+        if plan_only:
+            return plan
+
+        if plan['clone'] is not None:
+            clone_ic_root(base_location, tmp_ic_root)
+
+        ictree.execute_plan(plan, store_workers=store_workers)
+        ictree.summarize()
+
+        report = ictree.report()
 
     logging.info("IC tree ready in %s", ictree.icroot)
 
+    return finish_report(report, started, record_metrics)
+
+
+def apply_ic_plan(plan, store_workers=4, record_metrics=True):
+    started = time.time()
+
+    if plan['clone'] is not None:
+        clone_ic_root(plan['clone']['base_location'], plan['icroot'])
+
+    with ICTree(plan['icroot'], plan['master_suffix']) as ictree:
+        ictree.execute_plan(plan, store_workers=store_workers)
+        ictree.summarize()
+
+        return finish_report(ictree.report(), started, record_metrics)
+
+
+def update_ic_tree(ic_root, icfiles, suffix=None, scan_cache=None, scan_concurrency=16, store_workers=4, record_metrics=True):
+    """
+    adds icfiles to an existing tree in place, keeping the members already indexed; files which could not be added
+    are listed in the report as failed
+    """
+    started = time.time()
+
+    with ICTree(ic_root, suffix or "", scan_cache=scan_cache) as ictree:
+        failed = ictree.add_icfiles(icfiles, concurrency=scan_concurrency)
+        if len(ictree.icstructures) == 0:
+            raise Exception("none of %s new files could be added to %s" % (len(failed), ic_root))
+
+        ictree.add_index_members()
+
+        plan = ictree.plan()
+        plan['clone'] = None
+        logging.info("update plan totals: %s", plan['totals'])
+
+        ictree.execute_plan(plan, store_workers=store_workers)
+        ictree.summarize()
+
+        report = ictree.report()
+        report['failed'] = failed
+
+    logging.info("IC tree updated in %s", ic_root)
+
+    return finish_report(report, started, record_metrics)
+
+
+def build_ic_targets(spec, base_location=None, scan_cache=None, scan_concurrency=16, store_workers=4, record_metrics=True):
+    """
+    builds all targets of the spec (see osaic.ictargets) from one scan of their files;
+    targets are hard-linked clones of the base, and share stored members made from the same input
+    """
+    if base_location is None:
+        base_location = spec.get('base_location') or os.path.join(ic_collection, "bare")
+
+    candidates = collect_icfiles(spec.get('icfiles', ()), spec.get('from_file', ()))
+    own_icfiles = [collect_icfiles(target.get('icfiles', ()), target.get('from_file', ())) for target in spec['targets']]
+    icfiles = [fn for fn in dict.fromkeys(candidates + [fn for fns in own_icfiles for fn in fns])]
+
+    with ICTree(base_location, scan_cache=scan_cache, compact=spec.get('compact', False)) as scanner:
+        scanned = {}
+        for fn, result in zip(icfiles, scan_concurrently(scanner.scan_icfile, icfiles, scan_concurrency)):
+            if isinstance(result, Exception):
+                logging.error("failed (%s) to scan %s", result, fn)
+            else:
+                scanned[fn] = result
+        scan_stats = scanner.scan_stats
+
+    logging.info("scanned %s files for %s targets", len(scanned), len(spec['targets']))
+
+    shared_members = {}
+    reports = []
+    for target, own in zip(spec['targets'], own_icfiles):
+        started = time.time()
+        ic_root = os.path.join(ic_collection, target['version'])
+        link_tree(base_location, ic_root)
+
+        with ICTree(ic_root, target.get('suffix', spec.get('suffix', "")), scan_cache=scan_cache, compact=spec.get('compact', False)) as ictree:
+            ictree.shared_members = shared_members
+
+            selected = select_target_files(target, candidates, scanned) + [fn for fn in own if fn in scanned]
+            if len(selected) == 0:
+                logging.warning("no IC files for target %s", target['version'])
+            for fn in dict.fromkeys(selected):
+                ictree.add_icfile(fn, scanned[fn])
+            if ictree.compact:
+                ictree.compact_members()
+
+            ictree.write(store_workers)
+            ictree.summarize()
+
+            report = ictree.report()
+
+        if len(reports) == 0:
+            # the shared scan is accounted to the first target
+            report['scan'] = scan_stats
+
+        logging.info("IC tree ready in %s", ic_root)
+        reports.append(finish_report(report, started, record_metrics))
+
+    return reports
+
+
+def build_ic_shard(shard_dir, shard, n_shards, icfiles=(), from_file=(), revs_per_shard=REVS_PER_SHARD, scan_cache=None, scan_concurrency=16, store_workers=4):
+    """
+    stores members of one shard of the build in shard_dir, to be combined with merge_ic_shards
+    """
+    with ICTree(shard_dir, scan_cache=scan_cache) as ictree:
+        ictree.add_icfiles(collect_icfiles(icfiles, from_file), concurrency=scan_concurrency)
+        ictree.select_shard(shard, n_shards, revs_per_shard)
+        ictree.write_shard(shard, n_shards, revs_per_shard, store_workers=store_workers)
+        ictree.summarize()
+
+        return ictree.report()
+
+
+def merge_ic_shards(shard_dirs, suffix=None, base_location=None, in_place=False, version=None, record_metrics=True):
+    started = time.time()
+    # files are moved out of the shards, so all of them are checked first
+    manifests = read_manifests(shard_dirs)
+    tmp_ic_root = prepare_ic_root(base_location, in_place, version)
+
+    with ICTree(tmp_ic_root, suffix or "") as ictree:
+        for shard_dir, manifest in zip(shard_dirs, manifests):
+            ictree.merge_shard(shard_dir, manifest)
+
+        ictree.write_indices()
+        ictree.summarize()
+
+        report = ictree.report()
+
+    logging.info("IC tree merged from %s shards ready in %s", len(shard_dirs), ictree.icroot)
+
+    return finish_report(report, started, record_metrics)
+
+
+@cli.command()
+@click.argument('icfiles', nargs=-1)
+@click.option('-f', '--from-file', multiple=True)
+@click.option('-s', '--suffix')
+@click.option('-c', '--overwrite-index', is_flag=True)
+@click.option('-v', '--version', default=None)
+@click.option('-i', '--in-place', is_flag=True, default=False)
+@click.option('-b', '--base-location', default=None)
+@click.option('-j', '--scan-concurrency', default=16, help="number of IC files scanned at once")
+@click.option('-w', '--store-workers', default=4, help="number of IC files stored at once")
+@click.option('--shard', default=None, help="K/N: only store members of shard K of N into --shard-dir")
+@click.option('--shard-dir', default=None)
+@click.option('--revs-per-shard', default=REVS_PER_SHARD, help="revolution range of a DS kept in one shard")
+@click.option('--plan', 'plan_only', is_flag=True, default=False, help="only print the build plan as JSON")
+@click.option('--plan-file', default=None, help="write the build plan to this file")
+@click.option('--compact', is_flag=True, default=False, help="merge consecutive members with identical data into one")
+def create(icfiles, from_file, suffix, overwrite_index, base_location, in_place, version, scan_concurrency, store_workers, shard, shard_dir, revs_per_shard,
+           plan_only, plan_file, compact):
+    if shard is not None:
+        if shard_dir is None:
+            raise click.UsageError("--shard needs --shard-dir")
+        if compact:
+            # runs of identical members may cross shard boundaries
+            raise click.UsageError("--compact can not be used with --shard")
+        build_ic_shard(shard_dir, *parse_shard(shard), icfiles=icfiles, from_file=from_file, revs_per_shard=revs_per_shard,
+                       scan_concurrency=scan_concurrency, store_workers=store_workers)
+        return
+
+    if plan_only and plan_file is None:
+        plan_file = "-"
+
+    build_ic_version(icfiles, from_file, suffix=suffix, base_location=base_location, in_place=in_place, version=version,
+                     scan_concurrency=scan_concurrency, store_workers=store_workers,
+                     plan_fn=plan_file, plan_only=plan_only, compact=compact)
+
+
+def subset_ic_version(ic_version, rev_start, rev_stop, output=None, suffix=None):
+    if output is None:
+        output = "%s-r%.4i-%.4i" % (os.path.basename(os.path.normpath(ic_version)), rev_start, rev_stop)
+
+    src_root = os.path.join(ic_collection, ic_version)
+    dst_root = os.path.join(ic_collection, output)
+
+    # members valid from the start of the first revolution to the start of the one after the last
+    summary = subset_tree(src_root, dst_root, rev_to_ijd(rev_start), rev_to_ijd(rev_stop + 1), suffix=suffix)
+
+    for idx_name, (kept, total) in summary.items():
+        logging.info("%s %s of %s members", idx_name, kept, total)
+
+    logging.info("IC subset for revolutions %s-%s ready in %s", rev_start, rev_stop, dst_root)
+
+    return dst_root
+
+
+@cli.command()
+@click.argument('spec_fn')
+@click.option('-b', '--base-location', default=None, help="overrides base_location of the spec")
+@click.option('-j', '--scan-concurrency', default=16, help="number of IC files scanned at once")
+@click.option('-w', '--store-workers', default=4, help="number of IC files stored at once")
+def create_targets(spec_fn, base_location, scan_concurrency, store_workers):
+    build_ic_targets(read_targets_spec(spec_fn), base_location=base_location,
+                     scan_concurrency=scan_concurrency, store_workers=store_workers)
+
+
+@cli.command()
+@click.argument('ic_version')
+@click.option('-r', '--revs', required=True, help="revolution range A-B, inclusive")
+@click.option('-o', '--output', default=None, help="subset version name, IC_VERSION-rAAAA-BBBB by default")
+@click.option('-s', '--suffix', default=None, help="suffix of the master file, if the version was built with one")
+def subset(ic_version, revs, output, suffix):
+    subset_ic_version(ic_version, *parse_rev_range(revs), output=output, suffix=suffix)
+
+
+@cli.command()
+@click.argument('ic_version')
+@click.option('-o', '--output', default=None, help="bundle file, IC_VERSION.icbundle by default")
+def bundle(ic_version, output):
+    bundle_tree(os.path.join(ic_collection, ic_version), output or os.path.basename(os.path.normpath(ic_version)) + ".icbundle")
+
+
+@cli.command()
+@click.argument('bundle_fn')
+@click.option('-d', '--directory', default=None, help="where to extract, IC_COLLECTION/<bundled version> by default")
+@click.option('-j', '--workers', default=8)
+def unbundle(bundle_fn, directory, workers):
+    with ICBundle(bundle_fn) as icbundle:
+        icbundle.extract(directory or os.path.join(ic_collection, icbundle.root), workers)
+
+
+@cli.command()
+@click.option('-f', '--format', 'output_format', type=click.Choice(['prometheus', 'json']), default='prometheus')
+def metrics(output_format):
+    state = refresh_metrics(metrics_dir())
+
+    if output_format == 'json':
+        print(json.dumps(metrics_json(state), indent=1))
+    else:
+        print(prometheus_text(state), end="")
+
+
+@cli.command()
+@click.argument('plan_file')
+@click.option('-w', '--store-workers', default=4, help="number of IC files stored at once")
+def apply_plan(plan_file, store_workers):
+    apply_ic_plan(read_plan(plan_file), store_workers=store_workers)
+
+
+@cli.command()
+@click.argument('shard_dirs', nargs=-1, required=True)
+@click.option('-s', '--suffix')
+@click.option('-v', '--version', default=None)
+@click.option('-i', '--in-place', is_flag=True, default=False)
+@click.option('-b', '--base-location', default=None)
+def merge_shards(shard_dirs, suffix, base_location, in_place, version):
+    merge_ic_shards(shard_dirs, suffix=suffix, base_location=base_location, in_place=in_place, version=version)
+
+
+@cli.command()
+@click.argument('ic_version')
+@click.argument('directories', nargs=-1, required=True)
+@click.option('-s', '--suffix')
+@click.option('-p', '--pattern', 'patterns', multiple=True, help="file name pattern of IC files to pick up, *.fits and *.fits.gz by default")
+@click.option('--debounce', default=30., help="seconds without new files before a batch is applied")
+@click.option('--max-delay', default=600., help="longest time a new file waits to be applied")
+@click.option('--polling', is_flag=True, default=False, help="poll the directories even if inotify is available")
+@click.option('--poll-interval', default=10.)
+@click.option('-w', '--store-workers', default=4, help="number of IC files stored at once")
+@click.option('--max-attempts', default=3, help="times a file which can not be applied is tried before giving up on it")
+def watch(ic_version, directories, suffix, patterns, debounce, max_delay, polling, poll_interval, store_workers, max_attempts):
+    ic_root = os.path.join(ic_collection, ic_version)
+    if not os.path.exists(ic_root):
+        raise click.UsageError(f"no IC version {ic_version} in {ic_collection}")
+
+    scan_cache = ScanCache()
+
+    def apply(batch):
+        # files which could not be scanned are retried by watch_directories
+        return update_ic_tree(ic_root, batch, suffix=suffix, scan_cache=scan_cache, store_workers=store_workers)['failed']
+
+    watcher = make_watcher(directories, patterns or DEFAULT_PATTERNS, polling=polling, interval=poll_interval)
+    logging.info("watching %s for %s", directories, ic_root)
+
+    try:
+        watch_directories(watcher, apply, debounce=debounce, max_delay=max_delay, max_attempts=max_attempts)
+    finally:
+        watcher.close()
+
+
+@cli.command()
+@click.option('-H', '--host', default="127.0.0.1")
+@click.option('-p', '--port', default=8765)
+@click.option('-S', '--socket', 'socket_path', default=None, help="serve on a unix socket instead of TCP")
+@click.option('-w', '--workers', default=2)
+def serve(host, port, socket_path, workers):
+    from osaic.service import ICService
+
+    ICService(workers=workers).serve_forever(host=host, port=port, socket_path=socket_path)
 
 
  #       ictree.create_index_empty(DS)
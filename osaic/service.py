@@ -0,0 +1,293 @@
+"""
+Resident osa-ic build service.
+
+Jobs are submitted over a small local HTTP API (on TCP or a unix socket), run in a bounded worker pool,
+and share warm caches between jobs: metadata of scanned IC files, and master files read by inspect jobs.
+Templates are read by the heatool processes themselves, and builds read each index once, so neither is cached here.
+
+
+    POST /jobs              {"kind": "build"|"list"|"inspect"|"lookup", "params": {...}}
+    GET  /jobs              all known jobs
+    GET  /jobs/<id>         job status and result
+    GET  /jobs/<id>/log     log lines recorded while the job ran
+    GET  /status            worker pool and cache state
+"""
+
+import contextvars
+import json
+import logging
+import os
+import socketserver
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import astropy.io.fits as fits
+
+from osaic import integralicindex
+from osaic.icscan import ScanCache
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    __slots__ = ('id', 'kind', 'params', 'status', 'submitted', 'started', 'finished', 'result', 'error', 'log')
+
+    def __init__(self, kind, params, max_log_lines=10000):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = params
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.log = deque(maxlen=max_log_lines)
+
+    def as_dict(self):
+        return dict(
+            id=self.id,
+            kind=self.kind,
+            params=self.params,
+            status=self.status,
+            submitted=self.submitted,
+            started=self.started,
+            finished=self.finished,
+            result=self.result,
+            error=self.error,
+        )
+
+
+# job running in the current context; follows the job into scan and store threads, which copy the context
+current_job = contextvars.ContextVar("osaic_current_job", default=None)
+
+
+class JobLogHandler(logging.Handler):
+    """
+    Records log messages into the job running in the current context.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    def emit(self, record):
+        job = current_job.get()
+        if job is not None:
+            job.log.append(self.format(record))
+
+
+class ICService:
+    def __init__(self, workers=2, max_jobs=1000, max_masters=1000):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="osa-ic-job")
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.max_masters = max_masters
+
+        self.jobs = OrderedDict()
+        self.jobs_lock = threading.Lock()
+
+        self.building = set()
+        self.building_lock = threading.Lock()
+
+        self.scan_cache = ScanCache()
+        self.master_cache = {}
+
+        # job kinds which can be submitted
+        self.runners = {
+            "build": self.run_build,
+            "list": self.run_list,
+            "inspect": self.run_inspect,
+            "lookup": self.run_lookup,
+        }
+
+        self.log_handler = JobLogHandler()
+        logging.getLogger().addHandler(self.log_handler)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        logging.getLogger().removeHandler(self.log_handler)
+
+    def submit(self, kind, params):
+        runner = self.runners.get(kind)
+        if runner is None:
+            raise ValueError("unknown job kind: %s" % kind)
+
+        job = Job(kind, params)
+
+        with self.jobs_lock:
+            self.jobs[job.id] = job
+            self.forget_old_jobs()
+
+        self.pool.submit(self.run_job, job, runner)
+
+        return job
+
+    def forget_old_jobs(self):
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished is not None]:
+            if len(self.jobs) <= self.max_jobs:
+                break
+            del self.jobs[job_id]
+
+    def run_job(self, job, runner):
+        token = current_job.set(job)
+        job.status = "running"
+        job.started = time.time()
+        try:
+            job.result = runner(**job.params)
+            job.status = "done"
+        except Exception as e:
+            logger.error("job %s failed: %s", job.id, traceback.format_exc())
+            job.error = repr(e)
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            current_job.reset(token)
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.jobs_lock:
+            return [job.as_dict() for job in self.jobs.values()]
+
+    def status(self):
+        with self.jobs_lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+
+        return dict(
+            workers=self.workers,
+            jobs=counts,
+            scan_cache=self.scan_cache.stats(),
+            master_cache=len(self.master_cache),
+        )
+
+    def run_build(self, icfiles=(), from_file=(), suffix=None, base_location=None, in_place=False, version=None, compact=False):
+        if version is None and not in_place:
+            version = f"dev{time.strftime('%y%m%d.%H%M')}-{os.getpid()}-{threading.get_ident()}"
+
+        target = base_location if in_place else version
+        with self.building_lock:
+            if target in self.building:
+                raise RuntimeError("another build of %s is running" % target)
+            self.building.add(target)
+
+        try:
+            return integralicindex.build_ic_version(
+                icfiles, from_file,
+                suffix=suffix,
+                base_location=base_location,
+                in_place=in_place,
+                version=version,
+                scan_cache=self.scan_cache,
+                compact=compact,
+            )
+        finally:
+            with self.building_lock:
+                self.building.discard(target)
+
+    def run_list(self):
+        return sorted(integralicindex.list_ic_versions(), key=lambda x: x['mtime'])
+
+    def run_inspect(self, ic):
+        master_fn = str(integralicindex.ic_master_fn(ic))
+        key = (master_fn, os.path.getmtime(master_fn))
+
+        master = self.master_cache.get(key)
+        if master is None:
+            master = integralicindex.read_ic_master(ic)
+            if len(self.master_cache) >= self.max_masters:
+                self.master_cache.clear()
+            self.master_cache[key] = master
+
+        return master
+
+    def run_lookup(self, ic, ext_name):
+        with tempfile.TemporaryDirectory() as td:
+            # absolute output path: heatool would change the working directory of the whole process otherwise
+            sub_index_fn = integralicindex.find_ic(ic, ext_name, sub_index=os.path.join(td, "sub_index.fits"))
+            with fits.open(sub_index_fn) as f:
+                return [str(m).strip() for m in f[1].data['MEMBER_LOCATION']]
+
+    def make_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, code, content):
+                body = json.dumps(content, default=str).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = self.path.strip("/").split("/")
+
+                if path == ["status"]:
+                    return self.reply(200, service.status())
+
+                if path == ["jobs"]:
+                    return self.reply(200, service.list_jobs())
+
+                if len(path) in (2, 3) and path[0] == "jobs":
+                    job = service.get_job(path[1])
+                    if job is None:
+                        return self.reply(404, dict(error="no such job: %s" % path[1]))
+                    if len(path) == 2:
+                        return self.reply(200, job.as_dict())
+                    if path[2] == "log":
+                        return self.reply(200, [line for line in job.log])
+
+                return self.reply(404, dict(error="not found: %s" % self.path))
+
+            def do_POST(self):
+                if self.path.strip("/") != "jobs":
+                    return self.reply(404, dict(error="not found: %s" % self.path))
+
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    job = service.submit(request['kind'], request.get('params', {}))
+                except (ValueError, KeyError) as e:
+                    return self.reply(400, dict(error=repr(e)))
+
+                return self.reply(202, job.as_dict())
+
+            def address_string(self):
+                return str(self.client_address)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
+
+    def serve_forever(self, host="127.0.0.1", port=8765, socket_path=None):
+        if socket_path is None:
+            server = ThreadingHTTPServer((host, port), self.make_handler())
+            logger.info("serving on http://%s:%s", host, port)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = ThreadingUnixHTTPServer(socket_path, self.make_handler())
+            logger.info("serving on unix socket %s", socket_path)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("interrupted, shutting down")
+        finally:
+            server.server_close()
+            self.close()
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
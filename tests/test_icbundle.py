@@ -0,0 +1,31 @@
+import astropy.io.fits as fits
+import numpy as np
+
+from osaic.icbundle import bundle_tree, ICBundle, ALIGN
+
+
+def test_bundle(tmp_path):
+    root = tmp_path / "dev221201"
+    (root / "ic" / "ibis" / "mod").mkdir(parents=True)
+    (root / "idx" / "ic").mkdir(parents=True)
+
+    ds = fits.BinTableHDU.from_columns([fits.Column('V', '10E', array=np.arange(200, dtype='f4').reshape(20, 10))])
+    ds.header['EXTNAME'] = 'ISGR-EFFC-MOD'
+    fits.HDUList([fits.PrimaryHDU(), ds]).writeto(str(root / "ic" / "ibis" / "mod" / "isgr_effc_mod_0052.fits"))
+    (root / "idx" / "ic" / "version").write_text("2022-12-01T00:00:00")
+
+    bundle_fn = str(tmp_path / "dev221201.icbundle")
+    bundle_tree(str(root), bundle_fn)
+
+    with ICBundle(bundle_fn) as icbundle:
+        assert icbundle.root == "dev221201"
+        assert sorted(icbundle.names()) == ["ic/ibis/mod/isgr_effc_mod_0052.fits", "idx/ic/version"]
+        assert all(m['offset'] % ALIGN == 0 for m in icbundle.members.values() if 'offset' in m)
+
+        with icbundle.open_fits("ic/ibis/mod/isgr_effc_mod_0052.fits") as f:
+            assert f[1].header['EXTNAME'] == 'ISGR-EFFC-MOD'
+            assert (f[1].data['V'] == ds.data['V']).all()
+
+        icbundle.extract(str(tmp_path / "extracted"))
+
+    assert (tmp_path / "extracted" / "idx" / "ic" / "version").read_text() == "2022-12-01T00:00:00"
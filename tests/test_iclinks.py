@@ -0,0 +1,28 @@
+import os
+
+from osaic.iclinks import link_tree, unshare_file, write_replacing
+
+
+def test_link_tree(tmp_path):
+    base = tmp_path / "bare"
+    os.makedirs(base / "idx" / "ic")
+    (base / "idx" / "ic" / "ic_master_file.fits").write_text("master")
+    (base / "idx" / "ic" / "version").write_text("bare")
+
+    target = tmp_path / "dev"
+    assert link_tree(str(base), str(target)) == 2
+    assert link_tree(str(base), str(target)) == 0
+
+    master_fn = str(target / "idx" / "ic" / "ic_master_file.fits")
+    assert os.stat(master_fn).st_nlink == 2
+
+    assert unshare_file(master_fn)
+    with open(master_fn, "a") as f:
+        f.write(" updated")
+    assert not unshare_file(master_fn)
+
+    write_replacing(str(target / "idx" / "ic" / "version"), "dev")
+
+    assert (base / "idx" / "ic" / "ic_master_file.fits").read_text() == "master"
+    assert (base / "idx" / "ic" / "version").read_text() == "bare"
+    assert (target / "idx" / "ic" / "version").read_text() == "dev"
@@ -0,0 +1,25 @@
+import astropy.io.fits as fits
+
+from osaic.icmaster import update_master
+
+
+def make_master(fn):
+    fits.HDUList([
+        fits.PrimaryHDU(),
+        fits.BinTableHDU.from_columns([fits.Column('X', '1I', array=[1])]),
+        fits.BinTableHDU.from_columns([fits.Column('MEMBER_LOCATION', '64A', array=['ISGR-RMF.-RSP-IDX.fits'])]),
+        fits.BinTableHDU.from_columns([fits.Column('ISGR_RMF_RSP', '1I', array=[3])]),
+    ]).writeto(fn)
+
+
+def test_update_master(tmp_path):
+    fn = str(tmp_path / "ic_master_file.fits")
+    make_master(fn)
+
+    assert not update_master(fn, {'ISGR_RMF_RSP': 3})
+
+    assert update_master(fn, {'ISGR_RMF_RSP': 3, 'ISGR_EFFC_MOD': 7})
+    assert fits.getdata(fn, 3)[0]['ISGR_EFFC_MOD'] == 7
+    assert fits.getdata(fn, 2)[0]['MEMBER_LOCATION'] == 'ISGR-RMF.-RSP-IDX.fits'
+
+    assert not update_master(fn, {'ISGR_EFFC_MOD': 7})
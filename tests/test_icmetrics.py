@@ -0,0 +1,39 @@
+from osaic.icmetrics import record_build, refresh_metrics, prometheus_text
+
+
+def report(version, DS, n_files, duration=10.):
+    return dict(
+        icroot="/ic/" + version,
+        version=version,
+        DS={DS: dict(n_files=n_files, size=n_files * 1000, version=[1])},
+        heatool_calls={'txt2idx': 1, 'dal_attach': 1},
+        scan=dict(scanned=n_files, cached=0),
+        plan_totals=dict(copy=n_files, bytes=n_files * 500),
+        started=1000.,
+        finished=1000. + duration,
+        duration=duration,
+    )
+
+
+def test_record_build(tmp_path):
+    record_build(str(tmp_path), report("dev1", "ISGR-RMF.-RSP", 3))
+    record_build(str(tmp_path), report("dev1", "ISGR-EFFC-MOD", 5))
+    state = record_build(str(tmp_path), report("dev2", "ISGR-RMF.-RSP", 4))
+
+    assert state['builds_total'] == 3
+    assert state['heatool_calls_total']['txt2idx'] == 3
+    assert set(state['versions']['dev1']['DS']) == {"ISGR-RMF.-RSP", "ISGR-EFFC-MOD"}
+
+    text = prometheus_text(state)
+    assert 'osaic_ic_files{version="dev1",ds="ISGR-EFFC-MOD"} 5' in text
+    assert 'osaic_collection_files 12' in text
+    assert (tmp_path / "metrics.prom").read_text() == text
+
+
+def test_refresh_metrics_without_builds(tmp_path):
+    metrics_dir = str(tmp_path / ".metrics")
+
+    state = refresh_metrics(metrics_dir)
+
+    assert state['builds_total'] == 0
+    assert 'osaic_builds_total 0' in (tmp_path / ".metrics" / "metrics.prom").read_text()
@@ -0,0 +1,25 @@
+import os
+
+from osaic.icplan import changed_inputs, input_state
+
+
+def test_changed_inputs(tmp_path):
+    fns = [str(tmp_path / name) for name in ["a.fits", "b.fits", "c.fits", "d.fits"]]
+    for fn in fns:
+        with open(fn, "w") as f:
+            f.write("x" * 2880)
+
+    files = [dict(origin_filename=fn, **input_state(fn)) for fn in fns]
+    files.append(dict(origin_filename=str(tmp_path / "old_plan.fits")))
+    assert changed_inputs(files) == []
+
+    with open(fns[0], "a") as f:
+        f.write("y")
+    st = os.stat(fns[1])
+    os.utime(fns[1], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    os.remove(fns[2])
+
+    assert changed_inputs(files) == fns[:3]
+
+    # e.g. inputs found in the reference tree
+    assert changed_inputs(files[3:4], path=lambda fn: fn + ".missing") == fns[3:4]
@@ -0,0 +1,50 @@
+import contextvars
+import threading
+import time
+
+from osaic.icscan import ScanCache, scan_concurrently
+
+
+def test_scan_concurrently():
+    in_flight = []
+    lock = threading.Lock()
+    peak = [0]
+
+    def scan(item):
+        with lock:
+            in_flight.append(item)
+            peak[0] = max(peak[0], len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(item)
+        if item == 3:
+            raise ValueError(item)
+        return item * 2
+
+    results = scan_concurrently(scan, range(20), concurrency=4)
+
+    assert peak[0] <= 4
+    assert isinstance(results[3], ValueError)
+    assert results[:3] == [0, 2, 4]
+    assert results[19] == 38
+
+
+def test_scan_cache(tmp_path):
+    fn = tmp_path / "isgr_rmf_rsp_0052.fits"
+    fn.write_text("x")
+
+    cache = ScanCache()
+    assert cache.get(str(fn)) is None
+    cache.put(str(fn), ("ISGR-RMF.-RSP", 1, 52, ""))
+    assert cache.get(str(fn)) == ("ISGR-RMF.-RSP", 1, 52, "")
+
+    fn.write_text("xx")
+    assert cache.get(str(fn)) is None
+    assert cache.stats()['hits'] == 1
+
+
+def test_scan_concurrently_context():
+    job = contextvars.ContextVar("job", default=None)
+    job.set("job-1")
+
+    assert scan_concurrently(lambda item: job.get(), range(4), concurrency=2) == ["job-1"] * 4
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from osaic.icshard import parse_shard, read_manifest, read_manifests, shard_of, write_manifest
+from osaic.icstructure import ICFile
+
+
+def test_parse_shard():
+    assert parse_shard("0/4") == (0, 4)
+    assert parse_shard("3/4") == (3, 4)
+
+    for shard in ["4/4", "-1/4", "1"]:
+        with pytest.raises(ValueError):
+            parse_shard(shard)
+
+
+def test_shard_of():
+    # members of one DS and revolution bucket can collide in the tree, they always go to the same shard
+    assert len(set(shard_of("ISGR-EFFC-MOD", serial, 8, 100) for serial in range(100, 200))) == 1
+    assert shard_of("ISGR-EFFC-MOD", 52, 8, 100) == shard_of("ISGR-EFFC-MOD", 99, 8, 100)
+
+    shards = [shard_of(DS, serial, 8, 100) for DS in ["ISGR-EFFC-MOD", "ISGR-RISE-MOD", "ISGR-RMF.-RSP"] for serial in range(0, 3000, 100)]
+    assert all(0 <= shard < 8 for shard in shards)
+    assert len(set(shards)) > 1
+
+
+def test_manifest_round_trip(tmp_path):
+    icfile = ICFile("byrev/0052/isgr_effc_mod_0052.fits.gz", 3, 52, "abc", extension=2)
+    icfile.size = 2880 * 3
+
+    entry = icfile.as_dict()
+    entry.update(DS="ISGR-EFFC-MOD", stored="ic/ibis/mod/isgr_effc_mod_0052.fits")
+
+    write_manifest(str(tmp_path), 1, 4, 100, [entry])
+    manifest = read_manifest(str(tmp_path))
+
+    assert (manifest['shard'], manifest['n_shards'], manifest['revs_per_shard']) == (1, 4, 100)
+
+    read_icfile = ICFile.from_dict(manifest['files'][0])
+    assert read_icfile.as_dict() == icfile.as_dict()
+    assert manifest['files'][0]['stored'] == entry['stored']
+
+
+def write_shard_dir(shard_dir, shard, n_shards, revs_per_shard=100):
+    stored = "ic/ibis/mod/isgr_effc_mod_%04i.fits" % (shard + 52)
+    os.makedirs(os.path.dirname(os.path.join(shard_dir, stored)))
+    open(os.path.join(shard_dir, stored), "w").close()
+
+    entry = ICFile("isgr_effc_mod_%i.fits" % (shard + 52), 1, shard + 52, "").as_dict()
+    entry.update(DS="ISGR-EFFC-MOD", stored=stored)
+    write_manifest(shard_dir, shard, n_shards, revs_per_shard, [entry])
+    return shard_dir
+
+
+def test_read_manifests(tmp_path):
+    shard_dirs = [write_shard_dir(str(tmp_path / str(k)), k, 3) for k in range(3)]
+    assert [manifest['shard'] for manifest in read_manifests(shard_dirs)] == [0, 1, 2]
+
+    other_dir = write_shard_dir(str(tmp_path / "other"), 2, 3, revs_per_shard=50)
+
+    for dirs, match in [
+            ([], "no shards"),
+            (shard_dirs[:2], "each of the 3 shards once"),
+            (shard_dirs + shard_dirs[:1], "each of the 3 shards once"),
+            (shard_dirs[:2] + [other_dir], "different builds"),
+            (shard_dirs + [str(tmp_path / "missing")], "no shard manifest"),
+            ]:
+        with pytest.raises(ValueError, match=match):
+            read_manifests(dirs)
+
+    # files of a merged shard were moved out
+    os.remove(os.path.join(shard_dirs[1], "ic/ibis/mod/isgr_effc_mod_0053.fits"))
+    with pytest.raises(ValueError, match="merged already"):
+        read_manifests(shard_dirs)
@@ -0,0 +1,90 @@
+import contextvars
+import gzip
+import shutil
+
+import astropy.io.fits as fits
+import numpy as np
+
+from osaic.icstore import extension_digests, run_parallel, split_icfile, store_icfile
+
+
+def test_store_icfile_gz(tmp_path):
+    ds = fits.BinTableHDU.from_columns([fits.Column('MATRIX', '100E', array=np.random.rand(500, 100).astype('f4'))])
+    ds.header['EXTNAME'] = 'ISGR-RMF.-RSP'
+    ds.header['VSTART'] = 1000.5
+    ds.header['VSTOP'] = (2000., 'validity stop')
+
+    fn = str(tmp_path / "isgr_rmf_rsp_0052.fits")
+    fits.HDUList([fits.PrimaryHDU(), ds]).writeto(fn)
+    with open(fn, "rb") as f_in, gzip.open(fn + ".gz", "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+
+    dst = str(tmp_path / "stored.fits")
+    size = store_icfile(fn + ".gz", dst, {'VSTOP': 99999}, chunk_size=1000)
+
+    with fits.open(dst) as f:
+        assert len(f) == 2
+        assert f[1].header['VSTOP'] == 99999
+        assert f[1].header.comments['VSTOP'] == 'validity stop'
+        assert f[1].header['VSTART'] == 1000.5
+        assert (f[1].data['MATRIX'] == ds.data['MATRIX']).all()
+
+    assert size == len(open(fn, "rb").read())
+
+
+def test_extension_digests(tmp_path):
+    data = np.random.rand(50, 10).astype('f4')
+
+    hdus = [fits.PrimaryHDU()]
+    for vstart, d, extra in [(1000.5, data, {}), (1003.5, data, {'DATE': '2022-12-01T00:00:00', 'CREATOR': 'test'}),
+                             (1006.5, data * 2, {}), (1009.5, data, {'E_MIN': 15.})]:
+        ds = fits.BinTableHDU.from_columns([fits.Column('V', '10E', array=d)])
+        ds.header['EXTNAME'] = 'ISGR-EFFC-MOD'
+        ds.header['VSTART'] = vstart
+        ds.header.update(extra)
+        hdus.append(ds)
+
+    fn = str(tmp_path / "isgr_effc_mod.fits")
+    fits.HDUList(hdus).writeto(fn)
+
+    digests = extension_digests(fn, chunk_size=1000)
+
+    # the first two members differ only in validity and bookkeeping keywords
+    assert digests[1] == digests[2] != digests[3]
+    assert digests[4] not in (digests[1], digests[3])
+    assert extension_digests(fn, [3]) == {3: digests[3]}
+
+
+def test_split_icfile(tmp_path):
+    group = fits.BinTableHDU.from_columns([fits.Column('MEMBER_LOCATION', '256A', array=["a", "b"])])
+    group.header['EXTNAME'] = 'GROUPING'
+
+    hdus = [fits.PrimaryHDU(), group]
+    for vstart in [1000.5, 1003.5]:
+        ds = fits.BinTableHDU.from_columns([fits.Column('V', '10E', array=np.random.rand(50, 10).astype('f4'))])
+        ds.header['EXTNAME'] = 'ISGR-EFFC-MOD'
+        ds.header['VSTART'] = vstart
+        ds.header['VSTOP'] = vstart + 3
+        hdus.append(ds)
+
+    fn = str(tmp_path / "isgr_effc_mod.fits")
+    fits.HDUList(hdus).writeto(fn)
+
+    dsts = [str(tmp_path / "member_2.fits"), str(tmp_path / "member_3.fits")]
+    sizes = split_icfile(fn, {2: (dsts[0], {}), 3: (dsts[1], {'VSTOP': 1010.5})}, chunk_size=1000)
+
+    assert sorted(sizes) == dsts
+    for dst, ext, vstop in [(dsts[0], 2, 1003.5), (dsts[1], 3, 1010.5)]:
+        with fits.open(dst) as f:
+            assert len(f) == 2
+            assert f[1].header['EXTNAME'] == 'ISGR-EFFC-MOD'
+            assert f[1].header['VSTART'] == hdus[ext].header['VSTART']
+            assert f[1].header['VSTOP'] == vstop
+            assert (f[1].data['V'] == hdus[ext].data['V']).all()
+
+
+def test_run_parallel_context():
+    job = contextvars.ContextVar("job", default=None)
+    job.set("job-1")
+
+    assert run_parallel(lambda item: (item, job.get()), range(8), workers=4) == [(i, "job-1") for i in range(8)]
@@ -0,0 +1,98 @@
+import os
+
+import astropy.io.fits as fits
+import numpy as np
+import pytest
+
+from osaic.icsubset import parse_rev_range, select_members, subset_tree
+
+
+def test_parse_rev_range():
+    assert parse_rev_range("45-50") == (45, 50)
+    assert parse_rev_range("52") == (52, 52)
+
+
+def test_select_members():
+    vstart = np.array([10., 20., 30., 40., 50.])
+    vstop = np.array([99999., 99999., 99999., 99999., 25.])
+    version = np.array([1, 1, 1, 1, 2])
+
+    selected = select_members(vstart, vstop, version, 25., 45.)
+
+    # in effect at the range start, and starting in the range; version 2 member stopped before
+    assert selected.tolist() == [False, True, True, True, False]
+
+
+def make_tree(root, vstarts, suffix=None, outside_vstart=35.):
+    """
+    IC tree with one time-indexed DS, members valid from each VSTART on, and a member outside of the tree
+    """
+    os.makedirs(os.path.join(root, "idx", "ic"))
+    os.makedirs(os.path.join(root, "ic", "ibis", "mod"))
+
+    locations = []
+    for i, vstart in enumerate(vstarts):
+        name = "isgr_effc_mod_%04i.fits" % i
+        fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns([fits.Column('V', '1E', array=[vstart])])]) \
+            .writeto(os.path.join(root, "ic", "ibis", "mod", name))
+        with open(os.path.join(root, "ic", "ibis", "mod", ".version." + name), "w") as f:
+            f.write("hash%i" % i)
+        locations.append("../../ic/ibis/mod/" + name)
+
+    locations.append("../../../outside/isgr_effc_mod_0099.fits")
+    vstarts = vstarts + [outside_vstart]
+
+    index = fits.BinTableHDU.from_columns([
+        fits.Column('MEMBER_LOCATION', '256A', array=locations),
+        fits.Column('VERSION', '1J', array=[1] * len(locations)),
+        fits.Column('VSTART', '1D', array=vstarts),
+        fits.Column('VSTOP', '1D', array=[99999.] * len(locations)),
+    ])
+    index.header['EXTNAME'] = 'GROUPING'
+    fits.HDUList([fits.PrimaryHDU(), index]).writeto(os.path.join(root, "idx", "ic", "ISGR-EFFC-MOD-IDX.fits"))
+
+    group = fits.BinTableHDU.from_columns([fits.Column('MEMBER_LOCATION', '256A', array=["ISGR-EFFC-MOD-IDX.fits"])])
+    group.header['EXTNAME'] = 'GROUPING'
+    master_name = "ic_master_file" + ("_" + suffix if suffix else "") + ".fits"
+    fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns([fits.Column('X', '1I', array=[1])]), group]) \
+        .writeto(os.path.join(root, "idx", "ic", master_name))
+
+    with open(os.path.join(root, "idx", "ic", "version"), "w") as f:
+        f.write("dev221201")
+
+
+def test_subset_tree(tmp_path):
+    src = str(tmp_path / "dev221201")
+    dst = str(tmp_path / "subset")
+    make_tree(src, [10., 20., 30., 40., 50.])
+
+    summary = subset_tree(src, dst, 25., 45.)
+    assert summary == {"ISGR-EFFC-MOD-IDX.fits": (4, 6)}
+
+    # members in effect at the range start and starting in it are linked, with their version stores
+    linked = sorted(os.listdir(os.path.join(dst, "ic", "ibis", "mod")))
+    assert linked == sorted(name for i in [1, 2, 3] for name in ["isgr_effc_mod_%04i.fits" % i, ".version.isgr_effc_mod_%04i.fits" % i])
+    for name in linked:
+        assert os.path.samefile(os.path.join(src, "ic", "ibis", "mod", name), os.path.join(dst, "ic", "ibis", "mod", name))
+
+    # the index keeps the selected rows; the member outside of the tree is not linked
+    with fits.open(os.path.join(dst, "idx", "ic", "ISGR-EFFC-MOD-IDX.fits")) as f:
+        assert f[1].data['VSTART'].tolist() == [20., 30., 40., 35.]
+        assert str(f[1].data['MEMBER_LOCATION'][-1]).strip() == "../../../outside/isgr_effc_mod_0099.fits"
+    assert not os.path.exists(str(tmp_path / "outside"))
+
+    # the master file and the version are copied, not linked
+    for fn in ["idx/ic/ic_master_file.fits", "idx/ic/version"]:
+        assert open(os.path.join(dst, fn), "rb").read() == open(os.path.join(src, fn), "rb").read()
+        assert not os.path.samefile(os.path.join(src, fn), os.path.join(dst, fn))
+
+
+def test_subset_tree_suffix(tmp_path):
+    src = str(tmp_path / "dev221201")
+    make_tree(src, [10., 20.], suffix="rise")
+
+    with pytest.raises(FileNotFoundError, match="suffix"):
+        subset_tree(src, str(tmp_path / "subset"), 15., 25.)
+
+    assert subset_tree(src, str(tmp_path / "subset"), 15., 25., suffix="rise") == {"ISGR-EFFC-MOD-IDX.fits": (2, 3)}
+    assert os.path.exists(str(tmp_path / "subset" / "idx" / "ic" / "ic_master_file_rise.fits"))
@@ -0,0 +1,14 @@
+from osaic.ictargets import select_target_files
+
+
+def test_select_target_files():
+    scanned = {
+        "byrev/0052/isgr_rise_mod_0052.fits.gz": [("ISGR-RISE-MOD", 1, 52, "", None)],
+        "byrev/0053/isgr_rise_mod_0053.fits.gz": [("ISGR-RISE-MOD", 1, 53, "", None)],
+        "byrev/0053/isgr_effc_mod_0053.fits.gz": [("ISGR-EFFC-MOD", 1, 53, "", None)],
+    }
+    candidates = sorted(scanned) + ["byrev/0054/broken.fits"]
+
+    assert select_target_files({}, candidates, scanned) == sorted(scanned)
+    assert select_target_files({"revs": "53"}, candidates, scanned) == ["byrev/0053/isgr_effc_mod_0053.fits.gz", "byrev/0053/isgr_rise_mod_0053.fits.gz"]
+    assert select_target_files({"revs": "50-60", "patterns": ["*rise*"]}, candidates, scanned) == ["byrev/0052/isgr_rise_mod_0052.fits.gz", "byrev/0053/isgr_rise_mod_0053.fits.gz"]
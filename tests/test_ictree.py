@@ -0,0 +1,304 @@
+import os
+
+import astropy.io.fits as fits
+import numpy as np
+import pytest
+
+from osaic import integralicindex
+from osaic.icshard import read_manifest
+from osaic.integralicindex import ICTree
+
+
+def make_icfile(fn, DS, vstart, vstop=None, version=1, seed=0):
+    ds = fits.BinTableHDU.from_columns([fits.Column('V', '10E', array=np.random.RandomState(seed).rand(20, 10).astype('f4'))])
+    ds.header['EXTNAME'] = DS
+    ds.header['VSTART'] = vstart
+    ds.header['VSTOP'] = vstart + 3 if vstop is None else vstop
+    ds.header['VERSION'] = version
+    fits.HDUList([fits.PrimaryHDU(), ds]).writeto(fn)
+    return fn
+
+
+def test_shard_round_trip(tmp_path):
+    fns = [make_icfile(str(tmp_path / ("isgr_effc_mod_%i.fits" % rev)), "ISGR-EFFC-MOD", 1000 + rev, seed=rev) for rev in [52, 53, 152]]
+
+    shard_dir = str(tmp_path / "shard")
+    with ICTree(shard_dir) as ictree:
+        for rev, fn in zip([52, 53, 152], fns):
+            ictree.add_icfile(fn, [("ISGR-EFFC-MOD", 1, rev, "hash%i" % rev, None, None)])
+
+        ictree.select_shard(0, 1)
+        assert ictree.icstructures.n_files() == 3
+        ictree.write_shard(0, 1)
+
+    manifest = read_manifest(shard_dir)
+    assert sorted(entry['serial'] for entry in manifest['files']) == [52, 53, 152]
+
+    tree = str(tmp_path / "tree")
+    with ICTree(tree) as ictree:
+        ictree.merge_shard(shard_dir)
+
+        icfiles = ictree.icstructures["ISGR-EFFC-MOD"]
+        assert sorted(icfile.serial for icfile in icfiles) == [52, 53, 152]
+
+        for icfile in icfiles:
+            assert icfile.ic_store_filename == ictree.DS_to_fn("ISGR-EFFC-MOD", icfile.serial)
+            assert os.path.exists(icfile.ic_store_filename)
+            with open(icfile.version_store) as f:
+                assert f.read() == "hash%i" % icfile.serial
+            with fits.open(icfile.ic_store_filename) as f:
+                assert f[1].header['VSTOP'] == 99999
+
+    # members are moved out of the shard
+    assert not os.path.exists(os.path.join(shard_dir, "ic/ibis/mod/isgr_effc_mod_0052.fits"))
+
+
+def make_tree(root, DS, members):
+    """
+    minimal IC tree: master file listing the DS index, which lists members and points back to the master
+    """
+    os.makedirs(os.path.join(root, "idx", "ic"))
+
+    group = fits.BinTableHDU.from_columns([fits.Column('MEMBER_LOCATION', '256A', array=[DS + "-IDX.fits"])])
+    group.header['EXTNAME'] = 'GROUPING'
+    config = fits.BinTableHDU.from_columns([fits.Column(DS.replace("-", "_").replace(".", ""), '1I', array=[1])])
+    fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns([fits.Column('X', '1I', array=[1])]), group, config]) \
+        .writeto(os.path.join(root, "idx", "ic", "ic_master_file.fits"))
+
+    index = fits.BinTableHDU.from_columns([fits.Column('MEMBER_LOCATION', '256A', array=members)])
+    index.header['EXTNAME'] = 'GROUPING'
+    index.header['GRPID1'] = 1
+    index.header['GRPLC1'] = "ic_master_file.fits"
+    fits.HDUList([fits.PrimaryHDU(), index]).writeto(os.path.join(root, "idx", "ic", DS + "-IDX.fits"))
+
+
+def test_plan_attach_with_reference(tmp_path):
+    reference = str(tmp_path / "bare")
+    make_tree(reference, "ISGR-EFFC-MOD", ["../../ic/ibis/mod/isgr_effc_mod_0052.fits"])
+
+    fn = make_icfile(str(tmp_path / "isgr_effc_mod_53.fits"), "ISGR-EFFC-MOD", 1053)
+
+    plans = []
+    for icroot, reference_root in [(str(tmp_path / "dev"), reference), (reference, None)]:
+        with ICTree(icroot) as ictree:
+            ictree.reference_root = reference_root
+            ictree.add_icfile(fn, [("ISGR-EFFC-MOD", 1, 53, "", None, None)])
+            plans.append(ictree.plan())
+
+    # the index in the reference is attached already, whether the tree is cloned from it or updated in place
+    for plan in plans:
+        assert [(index['action'], index['attach']) for index in plan['indices']] == [("recreate", False)]
+        assert plan['totals']['heatool_calls'] == 1
+
+
+def make_indexed_icfile(fn, DS, vstarts, vstops=None, seeds=None):
+    """
+    indexed IC file: a grouping table followed by one member per VSTART, valid until the next one by default
+    """
+    group = fits.BinTableHDU.from_columns([fits.Column('MEMBER_LOCATION', '256A', array=["member"] * len(vstarts))])
+    group.header['EXTNAME'] = 'GROUPING'
+
+    hdus = [fits.PrimaryHDU(), group]
+    for i, vstart in enumerate(vstarts):
+        seed = i if seeds is None else seeds[i]
+        ds = fits.BinTableHDU.from_columns([fits.Column('V', '10E', array=np.random.RandomState(seed).rand(20, 10).astype('f4'))])
+        ds.header['EXTNAME'] = DS
+        ds.header['VSTART'] = vstart
+        if vstops is not None:
+            ds.header['VSTOP'] = vstops[i]
+        else:
+            ds.header['VSTOP'] = vstarts[i + 1] if i + 1 < len(vstarts) else vstart + 3
+        ds.header['VERSION'] = 1
+        hdus.append(ds)
+    fits.HDUList(hdus).writeto(fn)
+    return fn
+
+
+def test_scan_indexed_icfile(tmp_path, monkeypatch):
+    monkeypatch.setattr(integralicindex, "ijd_to_rev", lambda ijd: int((ijd - 1000) // 3))
+
+    # two members start in revolution 52
+    fn = make_indexed_icfile(str(tmp_path / "isgr_effc_mod.fits"), "ISGR-EFFC-MOD", [1156.5, 1157.5, 1159.5])
+
+    with ICTree(str(tmp_path / "tree")) as ictree:
+        scanned = ictree.scan_icfile(fn)
+        assert [(DS, serial, extension) for DS, version, serial, hashe, extension, digest in scanned] == \
+            [("ISGR-EFFC-MOD", 52, 2), ("ISGR-EFFC-MOD", 53, 3), ("ISGR-EFFC-MOD", 54, 4)]
+
+        ictree.add_icfile(fn, scanned)
+        os.makedirs(os.path.dirname(ictree.DS_to_fn("ISGR-EFFC-MOD")))
+        ictree.store_icfiles()
+
+        for icfile, (vstart, vstop) in zip(ictree.icstructures["ISGR-EFFC-MOD"], [(1156.5, 1157.5), (1157.5, 1159.5), (1159.5, 1162.5)]):
+            with fits.open(icfile.ic_store_filename) as f:
+                assert len(f) == 2
+                assert (f[1].header['VSTART'], f[1].header['VSTOP']) == (vstart, vstop)
+
+
+def test_moved_member_collision(tmp_path, monkeypatch):
+    monkeypatch.setattr(integralicindex, "ijd_to_rev", lambda ijd: int((ijd - 1000) // 3))
+
+    indexed = make_indexed_icfile(str(tmp_path / "isgr_effc_mod.fits"), "ISGR-EFFC-MOD", [1156.5, 1157.5])
+    single = make_icfile(str(tmp_path / "isgr_effc_mod_53.fits"), "ISGR-EFFC-MOD", 1159.5)
+
+    with ICTree(str(tmp_path / "tree")) as ictree:
+        # the second member of revolution 52 is moved to serial 53, the revolution of the single file
+        ictree.add_icfile(indexed)
+        ictree.add_icfile(single)
+
+        with pytest.raises(Exception, match="moved to serial 53"):
+            ictree.store_icfiles()
+
+
+def test_shared_members_extended_validity(tmp_path, monkeypatch):
+    monkeypatch.setattr(integralicindex, "ijd_to_rev", lambda ijd: int((ijd - 1000) // 3))
+
+    fn = make_indexed_icfile(str(tmp_path / "isgr_effc_mod.fits"), "ISGR-EFFC-MOD", [1156.5, 1159.5])
+
+    shared_members = {}
+    stored = []
+    for name, vstop in [("as_is", None), ("extended", 1165.5), ("as_is_again", None)]:
+        with ICTree(str(tmp_path / name)) as ictree:
+            ictree.shared_members = shared_members
+            icfile = ictree.add_icfile(fn)[0]
+            icfile.vstop = vstop
+            os.makedirs(os.path.dirname(ictree.DS_to_fn("ISGR-EFFC-MOD")))
+            ictree.store_icfiles()
+            stored.append(icfile.ic_store_filename)
+
+    vstops = [fits.getheader(stored_fn, 1)['VSTOP'] for stored_fn in stored]
+    assert vstops == [1159.5, 1165.5, 1159.5]
+    assert os.path.samefile(stored[0], stored[2])
+    assert not os.path.samefile(stored[0], stored[1])
+
+
+def test_compact_single_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(integralicindex, "ijd_to_rev", lambda ijd: int((ijd - 1000) // 3))
+
+    # by revolution: (seed of the data, VERSION)
+    content = {52: (0, 1), 53: (0, 1), 54: (0, 2), 55: (1, 2), 56: (1, 2), 57: (1, 2), 58: (1, 2)}
+    fns = {rev: make_icfile(str(tmp_path / ("isgr_effc_mod_%i.fits" % rev)), "ISGR-EFFC-MOD", 1000.5 + 3 * rev, version=version, seed=seed)
+           for rev, (seed, version) in content.items()}
+
+    with ICTree(str(tmp_path / "tree"), compact=True) as ictree:
+        for rev in range(52, 58):
+            ictree.add_icfile(fns[rev])
+        # without a digest, the file is kept
+        ictree.add_icfile(fns[58], [("ISGR-EFFC-MOD", 2, 58, "", None, None)])
+
+        assert ictree.compact_members() == 3
+
+        # a run is compacted into its first member, a new VERSION starts a new run
+        assert [(icfile.serial, kept.serial) for DS, icfile, kept in ictree.compacted] == [(53, 52), (56, 55), (57, 55)]
+        assert [icfile.serial for icfile in ictree.icstructures["ISGR-EFFC-MOD"]] == [52, 54, 55, 58]
+
+        # single files are valid until superseded, their VSTOP is not extended
+        assert all(kept.vstop is None for DS, icfile, kept in ictree.compacted)
+
+
+def test_compact_indexed_members(tmp_path, monkeypatch):
+    monkeypatch.setattr(integralicindex, "ijd_to_rev", lambda ijd: int((ijd - 1000) // 3))
+
+    DS = "ISGR-EFFC-MOD"
+    root = str(tmp_path / "tree")
+    make_tree(root, DS, [])
+
+    # the same content throughout, with a gap before the last member
+    fn = make_indexed_icfile(str(tmp_path / "isgr_effc_mod.fits"), DS,
+                             [1156.5, 1159.5, 1162.5, 1170.5], vstops=[1159.5, 1162.5, 1165.5, 1173.5], seeds=[0, 0, 0, 0])
+
+    with ICTree(root, compact=True) as ictree:
+        ictree.add_icfile(fn)
+        assert ictree.compact_members() == 2
+
+        assert [icfile.serial for icfile in ictree.icstructures[DS]] == [52, 56]
+        assert [icfile.vstop for icfile in ictree.icstructures[DS]] == [1165.5, None]
+
+        plan = ictree.plan()
+        compacted = [(entry['serial'], os.path.basename(entry['ic_store_filename'])) for entry in plan['files'] if entry['action'] == "compacted"]
+        assert compacted == [(53, "isgr_effc_mod_0052.fits"), (54, "isgr_effc_mod_0052.fits")]
+        assert [os.path.basename(member) for member in plan['indices'][0]['members']] == ["isgr_effc_mod_0052.fits", "isgr_effc_mod_0056.fits"]
+
+        os.makedirs(os.path.dirname(ictree.DS_to_fn(DS)))
+        ictree.store_icfiles()
+
+        vstops = [fits.getheader(icfile.ic_store_filename, 1)['VSTOP'] for icfile in ictree.icstructures[DS]]
+        assert vstops == [1165.5, 1173.5]
+
+
+def test_compact_superseding_member(tmp_path, monkeypatch):
+    monkeypatch.setattr(integralicindex, "ijd_to_rev", lambda ijd: int((ijd - 1000) // 3))
+
+    DS = "ISGR-EFFC-MOD"
+    root = str(tmp_path / "tree")
+    make_tree(root, DS, [])
+
+    # y53 replaces x53, and has the same content as a52
+    a52 = make_icfile(str(tmp_path / "a52.fits"), DS, 1156.5, seed=0)
+    x53 = make_icfile(str(tmp_path / "x53.fits"), DS, 1159.5, seed=1)
+    y53 = make_icfile(str(tmp_path / "y53.fits"), DS, 1159.5, seed=0)
+
+    with ICTree(root, compact=True) as ictree:
+        for fn in [a52, x53, y53]:
+            ictree.add_icfile(fn)
+        assert ictree.compact_members() == 1
+        assert [icfile.origin_filename for icfile in ictree.icstructures[DS]] == [a52]
+
+        plan = ictree.plan()
+        actions = [(os.path.basename(entry['origin_filename']), entry['action'], os.path.basename(entry['ic_store_filename'])) for entry in plan['files']]
+        assert sorted(actions) == [("a52.fits", "copy", "isgr_effc_mod_0052.fits"),
+                                   ("x53.fits", "superseded", "isgr_effc_mod_0052.fits"),
+                                   ("y53.fits", "compacted", "isgr_effc_mod_0052.fits")]
+        assert [os.path.basename(member) for member in plan['indices'][0]['members']] == ["isgr_effc_mod_0052.fits"]
+
+
+def test_moved_member_replaced(tmp_path, monkeypatch):
+    monkeypatch.setattr(integralicindex, "ijd_to_rev", lambda ijd: int((ijd - 1000) // 3))
+
+    DS = "ISGR-EFFC-MOD"
+    root = str(tmp_path / "tree")
+    make_tree(root, DS, ["../../ic/ibis/mod/isgr_effc_mod_%04i.fits" % serial for serial in [52, 53, 54]])
+
+    # an indexed file with members starting in revolutions 52, 52 and 53 was stored before
+    vstarts = [1156.5, 1157.5, 1159.5]
+    with ICTree(root) as ictree:
+        os.makedirs(os.path.dirname(ictree.DS_to_fn(DS)))
+        for serial, vstart, vstop in zip([52, 53, 54], vstarts, vstarts[1:] + [1162.5]):
+            make_icfile(ictree.DS_to_fn(DS, serial), DS, vstart, vstop=vstop)
+
+    # a file of revolution 54 would replace the member of revolution 53
+    single = make_icfile(str(tmp_path / "isgr_effc_mod_54.fits"), DS, 1162.5)
+    with ICTree(root) as ictree:
+        ictree.add_icfile(single)
+        with pytest.raises(Exception, match="starting in revolution 54, would replace"):
+            ictree.add_index_members()
+
+    # applying the indexed file again replaces its own members
+    indexed = make_indexed_icfile(str(tmp_path / "isgr_effc_mod.fits"), DS, vstarts)
+    with ICTree(root) as ictree:
+        ictree.add_icfile(indexed)
+        ictree.add_index_members()
+        assert [icfile.origin_filename for icfile in ictree.icstructures[DS]] == [indexed] * 3
+
+
+def test_execute_changed_plan(tmp_path):
+    DS = "ISGR-EFFC-MOD"
+    root = str(tmp_path / "tree")
+    make_tree(root, DS, [])
+
+    fn = make_icfile(str(tmp_path / "isgr_effc_mod_53.fits"), DS, 1053)
+    with ICTree(root) as ictree:
+        ictree.add_icfile(fn, [(DS, 1, 53, "", None, None)])
+        plan = ictree.plan()
+    assert [(entry['input_size'], entry['action']) for entry in plan['files']] == [(os.path.getsize(fn), "copy")]
+
+    # the input is replaced before the plan is executed
+    os.remove(fn)
+    make_icfile(fn, DS, 1053, seed=1)
+    st = os.stat(fn)
+    os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    with ICTree(root) as ictree:
+        with pytest.raises(Exception, match="changed since the plan was made"):
+            ictree.execute_plan(plan)
+        assert not os.path.exists(ictree.DS_to_fn(DS, 53))
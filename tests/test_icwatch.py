@@ -0,0 +1,120 @@
+import os
+
+from osaic import icwatch
+from osaic.icwatch import PollingWatcher
+
+
+def test_polling_watcher(tmp_path):
+    (tmp_path / "old.fits").write_bytes(b"x")
+
+    watcher = PollingWatcher([str(tmp_path)], interval=0)
+
+    os.makedirs(tmp_path / "0052")
+    (tmp_path / "0052" / "isgr_rise_mod_0052.fits.gz").write_bytes(b"x")
+    (tmp_path / "0052" / "hash.txt").write_text("h")
+
+    assert watcher.read_events() == [str(tmp_path / "0052" / "isgr_rise_mod_0052.fits.gz")]
+    assert watcher.read_events() == []
+
+
+def test_watch_debounce(tmp_path, monkeypatch):
+    fns = []
+    for name in "abc":
+        fns.append(str(tmp_path / (name + ".fits")))
+        open(fns[-1], "w").close()
+
+    # one event list per second: a burst of two files, a pause, then one more file
+    events = [[fns[0]], [fns[1]], [], [], [], [fns[2]], [], [], []]
+    clock = [0]
+
+    class Watcher:
+        def read_events(self, timeout=None):
+            clock[0] += 1
+            return events.pop(0)
+
+    monkeypatch.setattr(icwatch.time, "monotonic", lambda: clock[0])
+
+    batches = []
+    icwatch.watch(Watcher(), batches.append, debounce=2, stop=lambda: len(events) == 0)
+
+    assert [sorted(batch) for batch in batches] == [fns[:2], fns[2:]]
+
+
+def test_watch_failing_file(tmp_path, monkeypatch):
+    fns = []
+    for name in ["bad", "a", "b", "c"]:
+        fns.append(str(tmp_path / (name + ".fits")))
+        open(fns[-1], "w").close()
+    bad = fns[0]
+
+    events = [[bad], [], [], [fns[1]], [], [], [fns[2]], [], [], [fns[3]], [], [], []]
+    clock = [0]
+
+    class Watcher:
+        def read_events(self, timeout=None):
+            clock[0] += 1
+            return events.pop(0)
+
+    monkeypatch.setattr(icwatch.time, "monotonic", lambda: clock[0])
+
+    calls = []
+    applied = []
+
+    def callback(batch):
+        calls.append(list(batch))
+        if bad in batch:
+            raise RuntimeError("can not apply")
+        applied.extend(batch)
+
+    icwatch.watch(Watcher(), callback, debounce=2, stop=lambda: len(events) == 0, max_attempts=3)
+
+    assert applied == fns[1:]
+    assert sum(bad in batch for batch in calls if len(batch) == 1) == 3
+    assert calls[-1] == [fns[3]]
+
+
+def run_watch(monkeypatch, events, callback, **kwargs):
+    clock = [0]
+
+    class Watcher:
+        def read_events(self, timeout=None):
+            clock[0] += 1
+            return events.pop(0)
+
+    monkeypatch.setattr(icwatch.time, "monotonic", lambda: clock[0])
+    icwatch.watch(Watcher(), callback, debounce=2, stop=lambda: len(events) == 0, **kwargs)
+
+
+def test_watch_retry_quiet(tmp_path, monkeypatch):
+    fn = str(tmp_path / "a.fits")
+    open(fn, "w").close()
+
+    calls = []
+
+    def callback(batch):
+        calls.append(list(batch))
+        if len(calls) < 3:
+            raise RuntimeError("transient failure")
+
+    # no file arrives after the first one: it is retried anyway
+    run_watch(monkeypatch, [[fn]] + [[]] * 10, callback, max_attempts=3)
+
+    assert calls == [[fn]] * 3
+
+
+def test_watch_returned_failures(tmp_path, monkeypatch):
+    fns = []
+    for name in ["a", "unscannable"]:
+        fns.append(str(tmp_path / (name + ".fits")))
+        open(fns[-1], "w").close()
+
+    calls = []
+
+    def callback(batch):
+        # e.g. update_ic_tree adds the files it could scan, and reports the others
+        calls.append(list(batch))
+        return [fn for fn in batch if "unscannable" in fn]
+
+    run_watch(monkeypatch, [fns] + [[]] * 20, callback, max_attempts=3)
+
+    assert calls == [fns, [fns[1]], [fns[1]]]
@@ -0,0 +1,169 @@
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import astropy.io.fits as fits
+import pytest
+
+from osaic import integralicindex
+from osaic.icstore import run_parallel
+from osaic.service import ICService
+
+
+def make_master(ic_collection, ic, members):
+    os.makedirs(os.path.join(ic_collection, ic, "idx", "ic"))
+    group = fits.BinTableHDU.from_columns([fits.Column('MEMBER_LOCATION', '256A', array=members)])
+    group.header['EXTNAME'] = 'GROUPING'
+    config = fits.BinTableHDU.from_columns([fits.Column('ISGR_EFFC_MOD', '1I', array=[2])])
+    fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns([fits.Column('X', '1I', array=[1])]), group, config]) \
+        .writeto(os.path.join(ic_collection, ic, "idx", "ic", "ic_master_file.fits"))
+
+
+def wait(job, timeout=10.):
+    started = time.time()
+    while job.finished is None:
+        assert time.time() - started < timeout
+        time.sleep(0.01)
+    return job
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.setattr(integralicindex, "ic_collection", str(tmp_path))
+    make_master(str(tmp_path), "dev221201", ["ISGR-EFFC-MOD-IDX.fits"])
+
+    service = ICService(workers=1)
+    yield service
+    service.close()
+
+
+def test_list_and_inspect(service, tmp_path):
+    job = wait(service.submit("list", {}))
+    assert job.status == "done"
+    assert [version['path'] for version in job.result] == [str(tmp_path / "dev221201")]
+
+    for i in range(2):
+        job = wait(service.submit("inspect", {"ic": "dev221201"}))
+        assert job.status == "done"
+        assert job.result == dict(members=["ISGR-EFFC-MOD-IDX.fits"], versions={"ISGR_EFFC_MOD": 2})
+    assert service.status()['master_cache'] == 1
+
+    job = wait(service.submit("inspect", {"ic": "missing"}))
+    assert job.status == "failed"
+    assert "FileNotFoundError" in job.error
+
+
+def test_job_kinds(service):
+    # only job kinds of the dispatch table can be submitted, not any method of the service
+    for kind in ["job", "build_ic_version", "status"]:
+        with pytest.raises(ValueError):
+            service.submit(kind, {})
+
+
+def test_job_status(service, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(integralicindex, "list_ic_versions", lambda: release.wait(10) and [])
+
+    first = service.submit("list", {})
+    second = service.submit("list", {})
+
+    # one worker: the second job waits for the first one
+    while first.status == "queued":
+        time.sleep(0.01)
+    assert (first.status, second.status) == ("running", "queued")
+    assert first.started is not None and first.finished is None
+
+    release.set()
+    for job in [first, second]:
+        assert wait(job).status == "done"
+        assert job.submitted <= job.started <= job.finished
+    assert service.status()['jobs'] == {"done": 2}
+
+
+def test_forget_old_jobs(service):
+    service.max_jobs = 2
+
+    jobs = [wait(service.submit("list", {})) for i in range(4)]
+
+    # finished jobs beyond max_jobs are forgotten, oldest first
+    assert [job['id'] for job in service.list_jobs()] == [job.id for job in jobs[-2:]]
+    assert service.get_job(jobs[0].id) is None
+
+
+def test_job_log(service, monkeypatch):
+    def list_ic_versions():
+        logging.getLogger("osaic.test").warning("listing")
+        run_parallel(lambda i: logging.getLogger("osaic.test").warning("worker %s", i), range(3), workers=3)
+        return []
+
+    monkeypatch.setattr(integralicindex, "list_ic_versions", list_ic_versions)
+
+    job = wait(service.submit("list", {}))
+    other = wait(service.submit("inspect", {"ic": "dev221201"}))
+
+    # messages are recorded in the job which logged them, also from its worker threads
+    log = [line for line in job.log]
+    assert len(log) == 4
+    assert "listing" in log[0]
+    assert sorted(line.split(": ")[-1] for line in log[1:]) == ["worker 0", "worker 1", "worker 2"]
+    assert len(other.log) == 0
+
+
+def test_building_guard(service):
+    service.building.add("dev221201-guarded")
+
+    job = wait(service.submit("build", {"version": "dev221201-guarded"}))
+    assert job.status == "failed"
+    assert "another build" in job.error
+
+    # the running build keeps its target
+    assert service.building == {"dev221201-guarded"}
+
+
+def test_handler(service):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), service.make_handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def request(method, path, body=None):
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        connection.request(method, path, body=body)
+        response = connection.getresponse()
+        content = json.loads(response.read())
+        connection.close()
+        return response.status, content
+
+    try:
+        status, job = request("POST", "/jobs", json.dumps({"kind": "inspect", "params": {"ic": "dev221201"}}))
+        assert status == 202
+        assert job['status'] in ("queued", "running", "done")
+
+        wait(service.get_job(job['id']))
+
+        status, content = request("GET", "/jobs/%s" % job['id'])
+        assert status == 200
+        assert content['status'] == "done"
+        assert content['result']['members'] == ["ISGR-EFFC-MOD-IDX.fits"]
+
+        assert request("GET", "/jobs/%s/log" % job['id']) == (200, [])
+        assert [content['id'] for content in request("GET", "/jobs")[1]] == [job['id']]
+        assert request("GET", "/status")[1]['jobs'] == {"done": 1}
+
+        for method, path, body, code in [
+                ("GET", "/jobs/nope", None, 404),
+                ("GET", "/jobs/%s/other" % job['id'], None, 404),
+                ("GET", "/other", None, 404),
+                ("POST", "/other", "{}", 404),
+                ("POST", "/jobs", json.dumps({"kind": "job"}), 400),
+                ("POST", "/jobs", json.dumps({"params": {}}), 400),
+                ("POST", "/jobs", "not json", 400),
+                ]:
+            status, content = request(method, path, body)
+            assert status == code
+            assert "error" in content
+    finally:
+        server.shutdown()
+        server.server_close()